@@ -0,0 +1,191 @@
+from __future__ import print_function
+import config
+import json
+import os
+import socket
+import sys
+import time
+
+# Kept light on purpose: the client side runs before gfal_helper.py imports
+# anything else, so a forwarded request doesn't pay for those imports.
+
+# Requests that change anything, or need the terminal, always run in-process
+local_options = set(["--copy", "-cp", "--move", "-mv", "--mkdir", "-mkdir", "--delete", "-rm",
+                     "--copy_to_grid", "-cpg", "--sync", "--agent", "--no_agent", "--no-agent"])
+flush_size = 64*1024
+
+def _send(conn, message):
+    conn.sendall((json.dumps(message)+"\n").encode("utf-8"))
+
+def _messages(conn):
+    buffered = b""
+    while True:
+        data = conn.recv(flush_size)
+        if not data:
+            return
+        buffered += data
+        while b"\n" in buffered:
+            line, buffered = buffered.split(b"\n", 1)
+            yield json.loads(line.decode("utf-8"))
+
+def _connect(socket_path):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except socket.error:
+        conn.close()
+        return None
+    return conn
+
+def wants_agent(argv):
+    for arg in argv:
+        if arg.split("=", 1)[0] in local_options:
+            return False
+    return True
+
+def forward_if_running(argv, socket_path=config.agent_socket):
+    # Exits with the agent's exit code if it ran the request, otherwise
+    # returns so the caller can run it in-process
+    if not wants_agent(argv) or not os.path.exists(socket_path):
+        return
+    conn = _connect(socket_path)
+    if conn is None:
+        return
+    streams = {"out": sys.stdout, "err": sys.stderr}
+    started = False
+    try:
+        _send(conn, {"argv": argv, "cwd": os.getcwd()})
+        for message in _messages(conn):
+            if "fallback" in message:
+                return
+            if "exit" in message:
+                sys.stdout.flush()
+                sys.exit(message["exit"])
+            started = True
+            try:
+                streams[message["stream"]].write(message["data"])
+            except BrokenPipeError:
+                # Whatever we were piped into has gone, e.g. head
+                sys.exit(1)
+    except socket.error:
+        if not started:
+            return
+    finally:
+        conn.close()
+    print("Lost connection to the dpm-manager agent", file=sys.stderr)
+    sys.exit(1)
+
+def send_command(command, socket_path=config.agent_socket):
+    # Returns the agent's reply, or None if there is no agent
+    conn = _connect(socket_path) if os.path.exists(socket_path) else None
+    if conn is None:
+        return None
+    try:
+        _send(conn, {"command": command})
+        reply = ""
+        for message in _messages(conn):
+            if "exit" in message:
+                break
+            reply += message.get("data", "")
+        return reply
+    finally:
+        conn.close()
+
+class Channel():
+    # Buffers a request's output and sends it back in chunks, keeping stdout
+    # and stderr in the order they were written
+    def __init__(self, conn):
+        self.conn = conn
+        self.messages = []
+        self.size = 0
+
+    def write(self, stream, data):
+        if len(self.messages) > 0 and self.messages[-1]["stream"] == stream:
+            self.messages[-1]["data"] += data
+        else:
+            self.messages.append({"stream": stream, "data": data})
+        self.size += len(data)
+        if self.size >= flush_size or stream == "err":
+            self.flush()
+
+    def flush(self):
+        for message in self.messages:
+            _send(self.conn, message)
+        self.messages = []
+        self.size = 0
+
+class ChannelStream():
+    def __init__(self, channel, stream):
+        self.channel = channel
+        self.stream = stream
+
+    def write(self, data):
+        self.channel.write(self.stream, data)
+
+    def flush(self):
+        self.channel.flush()
+
+    def isatty(self):
+        return False
+
+def serve(handle, socket_path=config.agent_socket, idle_timeout=config.agent_idle_timeout):
+    # handle(argv, cwd, stdout, stderr) runs one request and returns its exit
+    # code, or None if it has to run in the client instead. Requests are
+    # served one at a time.
+    socket_dir = os.path.dirname(socket_path)
+    if not os.path.isdir(socket_dir):
+        os.makedirs(socket_dir)
+    if os.path.exists(socket_path):
+        if _connect(socket_path) is not None:
+            print("An agent is already running on {0}".format(socket_path), file=sys.stderr)
+            return 1
+        os.remove(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    server.listen(8)
+    server.settimeout(idle_timeout)
+    started = time.time()
+    served = 0
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break
+            conn.settimeout(None)
+            try:
+                request = next(_messages(conn), None)
+                if request is None:
+                    continue
+                if request.get("command") == "stop":
+                    _send(conn, {"exit": 0})
+                    break
+                if request.get("command") == "status":
+                    _send(conn, {"stream": "out", "data":
+                                 "Agent {0} up for {1:.0f}s, {2} requests served\n".format(
+                                     os.getpid(), time.time()-started, served)})
+                    _send(conn, {"exit": 0})
+                    continue
+                channel = Channel(conn)
+                code = handle(request["argv"], request["cwd"],
+                              ChannelStream(channel, "out"), ChannelStream(channel, "err"))
+                served += 1
+                if code is None:
+                    _send(conn, {"fallback": True})
+                else:
+                    channel.flush()
+                    _send(conn, {"exit": code})
+            except (socket.error, ValueError):
+                # Client gone or garbled request, nothing to report back to
+                continue
+            finally:
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+    return 0
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Stand-in for the gfal-* command line tools, for benchmarking without a
+# storage element. Link it into a directory on PATH under each tool's name
+# (run_bench.py does this). Behaviour is set through the environment:
+#
+#   FAKE_SE_ROOT       local directory standing in for the storage element
+#   FAKE_SE_TREE       "depth,fanout,files[,size]": list a synthetic tree
+#                      instead of FAKE_SE_ROOT. Every directory above `depth`
+#                      holds `fanout` subdirectories d0, d1, ... and every
+#                      directory holds `files` files. Nothing is stored, so
+#                      trees with millions of entries cost nothing to create.
+#   FAKE_SE_LATENCY    seconds added to every call
+#   FAKE_SE_JITTER     extra random latency, up to this many seconds
+#   FAKE_SE_BANDWIDTH  MB/s for copies, on top of the latency
+#   FAKE_SE_FAIL_RATE  fraction of calls failing with a connection reset
+#   FAKE_SE_CORRUPT_RATE  fraction of local copies silently corrupted
+from __future__ import print_function
+import os
+import random
+import shutil
+import stat
+import sys
+import time
+
+se_root = os.environ.get("FAKE_SE_ROOT", "/tmp/fake-se")
+tree = os.environ.get("FAKE_SE_TREE")
+latency = float(os.environ.get("FAKE_SE_LATENCY", "0"))
+jitter = float(os.environ.get("FAKE_SE_JITTER", "0"))
+bandwidth = float(os.environ.get("FAKE_SE_BANDWIDTH", "0"))
+fail_rate = float(os.environ.get("FAKE_SE_FAIL_RATE", "0"))
+corrupt_rate = float(os.environ.get("FAKE_SE_CORRUPT_RATE", "0"))
+
+# Everything after this in a grid URL is the path below the user's directory
+home_marker = "/home/pheno/"
+runcards = ["LO", "NLO-R", "NLO-V", "NNLO-RR", "NNLO-RV", "NNLO-VV"]
+synthetic_mtime = time.time()-3600
+# Options taking a value, so the value isn't mistaken for a URL
+value_options = ["-t", "-T", "-n", "--nbstreams", "--from-file", "--copy-mode"]
+
+def fail(message, code):
+    sys.stderr.write(message+"\n")
+    sys.exit(code)
+
+def split_args(argv):
+    options, positional = {}, []
+    i = 0
+    while i < len(argv):
+        if argv[i] in value_options and i+1 < len(argv):
+            options[argv[i]] = argv[i+1]
+            i += 2
+            continue
+        if argv[i].startswith("-"):
+            options[argv[i]] = True
+        else:
+            positional.append(argv[i])
+        i += 1
+    return options, positional
+
+def is_grid(url):
+    return "://" in url and not url.startswith("file://")
+
+def grid_parts(url):
+    path = url.split("://", 1)[1]
+    path = path.split("/", 1)[1] if "/" in path else ""
+    if home_marker.strip("/") in path:
+        path = path.split(home_marker, 1)[1]
+        # Drop the user directory
+        path = path.split("/", 1)[1] if "/" in path else ""
+    return [i for i in path.split("/") if i != ""]
+
+def local_path(url):
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    if "://" not in url:
+        return url
+    return os.path.join(se_root, url.split("://", 1)[1].split("/", 1)[1])
+
+def ls_date(mtime):
+    return time.strftime("%b %d %H:%M", time.localtime(mtime))
+
+def ls_line(mode, nlink, size, mtime, name):
+    return "{0} {1:3} {2:5} {3:5} {4:12} {5} {6}".format(
+        stat.filemode(mode), nlink, 101, 102, size, ls_date(mtime), name)
+
+# Synthetic trees
+
+def tree_shape():
+    shape = [int(i) for i in tree.split(",")]
+    if len(shape) == 3:
+        shape.append(1000000)
+    return shape
+
+def synthetic_name(no):
+    return "run-{0}-{1}.dat".format(runcards[no % len(runcards)], no//len(runcards)+1)
+
+def synthetic_size(no, base_size):
+    # Deterministic spread between a tenth and twice the base size
+    return base_size*(10+(no*2654435761) % 191)//100
+
+def synthetic_entry(parts):
+    # None if parts isn't in the tree, else "dir" or the file's size
+    depth, fanout, files, base_size = tree_shape()
+    for level, part in enumerate(parts):
+        if part.startswith("d") and part[1:].isdigit():
+            if level >= depth or int(part[1:]) >= fanout:
+                return None
+            continue
+        if level != len(parts)-1:
+            return None
+        for no in candidate_numbers(part, files):
+            return synthetic_size(no, base_size)
+        return None
+    return "dir"
+
+def candidate_numbers(name, files):
+    if not (name.startswith("run-") and name.endswith(".dat")):
+        return
+    try:
+        runcard, seed = name[len("run-"):-len(".dat")].rsplit("-", 1)
+        no = (int(seed)-1)*len(runcards)+runcards.index(runcard)
+    except ValueError:
+        return
+    if 0 <= no < files:
+        yield no
+
+def synthetic_ls(url):
+    parts = grid_parts(url)
+    entry = synthetic_entry(parts)
+    if entry is None:
+        fail("gfal-ls error: 2 (No such file or directory) - {0}".format(url), 2)
+    if entry != "dir":
+        print(ls_line(stat.S_IFREG | 0o644, 1, entry, synthetic_mtime, url))
+        return
+    depth, fanout, files, base_size = tree_shape()
+    out = sys.stdout
+    if len(parts) < depth:
+        for no in range(fanout):
+            out.write(ls_line(stat.S_IFDIR | 0o755, 2, 0, synthetic_mtime, "d{0}".format(no))+"\n")
+    for no in range(files):
+        out.write(ls_line(stat.S_IFREG | 0o644, 1, synthetic_size(no, base_size),
+                          synthetic_mtime, synthetic_name(no))+"\n")
+
+def synthetic_copy(src, dst, options):
+    size = synthetic_entry(grid_parts(src)) if is_grid(src) else os.path.getsize(local_path(src))
+    if size is None or size == "dir":
+        fail("gfal-copy error: 2 (No such file or directory) - {0}".format(src), 2)
+    transfer_delay(size)
+    if not is_grid(dst):
+        path = local_path(dst)
+        if os.path.exists(path) and "-f" not in options:
+            fail("gfal-copy error: 17 (File exists) - {0}".format(dst), 17)
+        # Sparse file of the right size: the benchmark is about scheduling,
+        # not disk bandwidth
+        with open(path, "wb") as outfile:
+            outfile.truncate(size)
+        corrupt(path)
+
+# Local directory standing in for the storage element
+
+def real_ls(url):
+    path = local_path(url)
+    if not os.path.exists(path):
+        fail("gfal-ls error: 2 (No such file or directory) - {0}".format(url), 2)
+    if not os.path.isdir(path):
+        st = os.stat(path)
+        print(ls_line(st.st_mode, st.st_nlink, st.st_size, st.st_mtime, url))
+        return
+    for name in sorted(os.listdir(path)):
+        st = os.stat(os.path.join(path, name))
+        print(ls_line(st.st_mode, st.st_nlink, st.st_size, st.st_mtime, name))
+
+def real_copy(src, dst, options):
+    src_path, dst_path = local_path(src), local_path(dst)
+    if not os.path.isfile(src_path):
+        fail("gfal-copy error: 2 (No such file or directory) - {0}".format(src), 2)
+    if os.path.exists(dst_path) and "-f" not in options:
+        fail("gfal-copy error: 17 (File exists) - {0}".format(dst), 17)
+    if "-p" in options and not os.path.isdir(os.path.dirname(dst_path)):
+        os.makedirs(os.path.dirname(dst_path))
+    transfer_delay(os.path.getsize(src_path))
+    shutil.copyfile(src_path, dst_path)
+    if not is_grid(dst):
+        corrupt(dst_path)
+
+def real_rm(url, options):
+    # Like gfal-rm, report each URL and carry on with the rest
+    path = local_path(url)
+    if os.path.isdir(path):
+        if "-r" not in options:
+            sys.stderr.write("gfal-rm error: 21 (Is a directory) - {0}\n".format(url))
+            print("{0}\tFAILED".format(url))
+            return False
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+    else:
+        print("{0}\tMISSING".format(url))
+        return False
+    print("{0}\tDELETED".format(url))
+    return True
+
+def corrupt(path):
+    if corrupt_rate > 0 and random.random() < corrupt_rate and os.path.getsize(path) > 0:
+        with open(path, "r+b") as outfile:
+            byte = outfile.read(1)
+            outfile.seek(0)
+            outfile.write(bytearray([(bytearray(byte)[0]+1) % 256]))
+
+def transfer_delay(size):
+    if bandwidth > 0:
+        time.sleep(size/(bandwidth*1e6))
+
+def main(command, argv):
+    if latency > 0 or jitter > 0:
+        time.sleep(latency+random.random()*jitter)
+    if random.random() < fail_rate:
+        fail("{0} error: 104 (Connection reset by peer)".format(command), 104)
+    options, positional = split_args(argv)
+
+    if command == "gfal-ls":
+        if tree is not None:
+            synthetic_ls(positional[0])
+        else:
+            real_ls(positional[0])
+    elif command == "gfal-copy":
+        copy = synthetic_copy if tree is not None else real_copy
+        if "--from-file" in options:
+            with open(options["--from-file"]) as infile:
+                srcs = [i.strip() for i in infile if i.strip() != ""]
+            for src in srcs:
+                copy(src, "{0}/{1}".format(positional[-1].rstrip("/"), src.rsplit("/", 1)[-1]),
+                     options)
+        else:
+            copy(positional[0], positional[1], options)
+    elif command == "gfal-rm":
+        ok = True
+        for url in positional:
+            if tree is None:
+                ok = real_rm(url, options) and ok
+            elif synthetic_entry(grid_parts(url)) is None:
+                print("{0}\tMISSING".format(url))
+                ok = False
+            else:
+                print("{0}\tDELETED".format(url))
+        if not ok:
+            sys.exit(2)
+    elif command == "gfal-rename":
+        if tree is None:
+            os.rename(local_path(positional[0]), local_path(positional[1]))
+    elif command == "gfal-mkdir":
+        if tree is None and not os.path.isdir(local_path(positional[0])):
+            os.makedirs(local_path(positional[0]))
+    elif command == "gfal-sum":
+        import zlib
+        value = 1
+        if tree is None:
+            with open(local_path(positional[0]), "rb") as infile:
+                for chunk in iter(lambda: infile.read(1 << 20), b""):
+                    value = zlib.adler32(chunk, value)
+        else:
+            size = synthetic_entry(grid_parts(positional[0]))
+            if size is None or size == "dir":
+                fail("gfal-sum error: 2 (No such file or directory) - {0}".format(
+                    positional[0]), 2)
+            # Synthetic files are all zeros, whose adler32 only depends on the size
+            value = (size % 65521) << 16 | 1
+        print("{0} {1:08x}".format(positional[0], value & 0xffffffff))
+    else:
+        fail("fake_gfal: unknown command {0}".format(command), 1)
+
+if __name__ == "__main__":
+    command = os.path.basename(sys.argv[0])
+    if command.startswith("fake_gfal"):
+        command, argv = "gfal-"+sys.argv[1], sys.argv[2:]
+    else:
+        argv = sys.argv[1:]
+    main(command, argv)
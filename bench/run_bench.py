@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# Runs dpm-manager against fake_gfal.py and records wall time, peak memory,
+# throughput and scheduling efficiency per scenario in a JSON lines file, so
+# that runs from different commits can be compared with --compare.
+from __future__ import print_function
+import argparse
+import datetime
+import json
+import os
+import shutil
+import subprocess as sp
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+gfal_helper = os.path.join(repo_dir, "gfal_helper.py")
+fake_gfal = os.path.join(bench_dir, "fake_gfal.py")
+tools = ["gfal-ls", "gfal-copy", "gfal-rm", "gfal-rename", "gfal-mkdir", "gfal-sum"]
+
+def tree_entries(depth, fanout, files):
+    # Directories and files listed in a synthetic tree
+    entries, dirs = 0, 1
+    for level in range(depth+1):
+        entries += dirs*files
+        if level < depth:
+            entries += dirs*fanout
+            dirs *= fanout
+    return entries
+
+def get_scenarios(scale):
+    flat = int(100000*scale)
+    transfers = max(int(200*scale), 1)
+    return [
+        {"name": "list-flat",
+         "about": "one directory of {0} files, filtered and printed".format(flat),
+         "tree": (0, 0, flat), "env": {},
+         "args": ["-s", "NLO"], "entries": tree_entries(0, 0, flat)},
+        {"name": "list-tree",
+         "about": "recursive listing, 20ms per call",
+         "tree": (3, 8, 50), "env": {"FAKE_SE_LATENCY": "0.02"},
+         "args": ["-rc"], "entries": tree_entries(3, 8, 50)},
+        {"name": "copy",
+         "about": "{0} downloads, 50ms per call, 100MB/s".format(transfers),
+         "tree": (0, 0, transfers, 1000000),
+         "env": {"FAKE_SE_LATENCY": "0.05", "FAKE_SE_BANDWIDTH": "100"},
+         "args": ["-cp", "-o", "{outdir}"], "entries": transfers, "operation": "copy"},
+        {"name": "copy-flaky",
+         "about": "{0} downloads, 50ms per call, 5% failing".format(transfers),
+         "tree": (0, 0, transfers, 1000000),
+         "env": {"FAKE_SE_LATENCY": "0.05", "FAKE_SE_FAIL_RATE": "0.05"},
+         "args": ["-cp", "-o", "{outdir}"], "entries": transfers, "operation": "copy"},
+        {"name": "delete",
+         "about": "{0} deletions, 50ms per call".format(transfers),
+         "tree": (0, 0, transfers), "env": {"FAKE_SE_LATENCY": "0.05"},
+         "args": ["-rm"], "stdin": "y\n", "entries": transfers, "operation": "rm"},
+    ]
+
+def git_commit():
+    try:
+        return sp.check_output(["git", "describe", "--always", "--dirty"], cwd=repo_dir,
+                               stderr=sp.DEVNULL).decode().strip()
+    except (OSError, sp.CalledProcessError):
+        return "unknown"
+
+def make_bin_dir(workdir):
+    bin_dir = os.path.join(workdir, "bin")
+    os.makedirs(bin_dir)
+    for tool in tools:
+        os.symlink(fake_gfal, os.path.join(bin_dir, tool))
+    return bin_dir
+
+def efficiency(stats, operation, wall_time):
+    # Time the operations would take back to back at the peak concurrency,
+    # over the time they actually took: 1.0 means no idle slots.
+    ops = [v for k, v in stats["operations"].items() if k.startswith(operation+":")]
+    peak = stats.get("concurrency_peak", 1)
+    if len(ops) == 0 or wall_time <= 0:
+        return None
+    busy = sum(i["count"]*i["latency_p50"] for i in ops)
+    return busy/max(peak, 1)/wall_time
+
+def run_scenario(scenario, workdir, bin_dir, args):
+    outdir = tempfile.mkdtemp(dir=workdir)
+    metrics_file = os.path.join(workdir, "metrics.json")
+    env = dict(os.environ)
+    env.update(scenario["env"])
+    env["PATH"] = bin_dir+os.pathsep+env.get("PATH", "")
+    env["FAKE_SE_TREE"] = ",".join(str(i) for i in scenario["tree"])
+    env.setdefault("USER", "bench")
+    cmd = [sys.executable, gfal_helper, "--no-cache", "--backend", "cli",
+           "--metrics-out", metrics_file]
+    cmd += [i.format(outdir=outdir) for i in scenario["args"]]
+    if args.threads is not None:
+        cmd += ["-j", str(args.threads)]
+
+    output_file = os.path.join(workdir, "output.txt")
+    with open(output_file, "w") as outfile:
+        start_time = time.time()
+        proc = sp.Popen(cmd, env=env, stdin=sp.PIPE, stdout=outfile, stderr=sp.STDOUT)
+        proc.stdin.write(scenario.get("stdin", "").encode())
+        proc.stdin.close()
+        # wait4 gives the resource usage of this child alone
+        _, status, usage = os.wait4(proc.pid, 0)
+        proc.returncode = status
+        wall_time = time.time()-start_time
+    with open(output_file) as infile:
+        output_lines = sum(1 for i in infile)
+    shutil.rmtree(outdir)
+
+    result = {"scenario": scenario["name"], "about": scenario["about"],
+              "commit": args.commit, "date": args.date,
+              "wall_time": round(wall_time, 3),
+              # ru_maxrss is in kB on Linux
+              "max_rss_mb": round(usage.ru_maxrss/1024.0, 1),
+              "cpu_time": round(usage.ru_utime+usage.ru_stime, 3),
+              "entries": scenario["entries"],
+              "entries_per_s": round(scenario["entries"]/wall_time, 1),
+              "output_lines": output_lines,
+              "exit_status": os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1}
+    if os.path.isfile(metrics_file):
+        with open(metrics_file) as infile:
+            stats = json.load(infile)
+        os.remove(metrics_file)
+        result["retries"] = sum(i["retries"] for i in stats["operations"].values())
+        result["errors"] = sum(i["errors"] for i in stats["operations"].values())
+        result["concurrency_peak"] = stats.get("concurrency_peak")
+        if "operation" in scenario:
+            value = efficiency(stats, scenario["operation"], wall_time)
+            result["efficiency"] = round(value, 3) if value is not None else None
+    return result
+
+def load_results(path):
+    results = []
+    if os.path.isfile(path):
+        with open(path) as infile:
+            for line in infile:
+                if line.strip() != "":
+                    results.append(json.loads(line))
+    return results
+
+def print_result(result, baseline):
+    line = "{0:12} {1:9.2f}s {2:8.1f}MB {3:12.1f}/s".format(
+        result["scenario"], result["wall_time"], result["max_rss_mb"], result["entries_per_s"])
+    if result.get("efficiency") is not None:
+        line += "  efficiency {0:.2f}".format(result["efficiency"])
+    if baseline is not None:
+        line += "  ({0:+.0%} time, {1:+.0%} memory vs {2})".format(
+            result["wall_time"]/baseline["wall_time"]-1,
+            result["max_rss_mb"]/baseline["max_rss_mb"]-1, baseline["commit"])
+    if result["exit_status"] != 0:
+        line += "  [exit status {0}]".format(result["exit_status"])
+    print(line)
+
+def get_args():
+    parser = argparse.ArgumentParser(description="dpm-manager benchmarks against a fake SE")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios to run, all of them by default")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiply the number of files in each scenario, "
+                        "e.g. 10 for a million entry listing")
+    parser.add_argument("--threads", "-j", type=int, default=None,
+                        help="fixed number of threads, adaptive by default")
+    parser.add_argument("--output", default=os.path.join(bench_dir, "results.jsonl"),
+                        help="file the results are appended to")
+    parser.add_argument("--compare", default=None, metavar="COMMIT",
+                        help="compare with the latest results recorded for this commit, "
+                        "by default the latest from any other commit")
+    parser.add_argument("--no_save", action="store_true", default=False,
+                        help="don't record the results")
+    parser.add_argument("--list", action="store_true", default=False,
+                        help="list the scenarios and exit")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = get_args()
+    args.commit = git_commit()
+    args.date = datetime.datetime.now().isoformat()
+    scenarios = get_scenarios(args.scale)
+    if args.list:
+        for scenario in scenarios:
+            print("{0:12} {1}".format(scenario["name"], scenario["about"]))
+        sys.exit(0)
+    if args.scenarios != []:
+        unknown = set(args.scenarios)-set(i["name"] for i in scenarios)
+        if len(unknown) > 0:
+            print("Unknown scenario(s): {0}".format(", ".join(sorted(unknown))))
+            sys.exit(1)
+        scenarios = [i for i in scenarios if i["name"] in args.scenarios]
+
+    previous = load_results(args.output)
+    workdir = tempfile.mkdtemp(prefix="dpm-bench-")
+    try:
+        bin_dir = make_bin_dir(workdir)
+        for scenario in scenarios:
+            result = run_scenario(scenario, workdir, bin_dir, args)
+            baseline = None
+            for old in reversed(previous):
+                if old["scenario"] != result["scenario"]:
+                    continue
+                if (args.compare is None and old["commit"] != args.commit) or \
+                   old["commit"] == args.compare:
+                    baseline = old
+                    break
+            print_result(result, baseline)
+            if not args.no_save:
+                with open(args.output, "a") as outfile:
+                    outfile.write(json.dumps(result, sort_keys=True)+"\n")
+    finally:
+        shutil.rmtree(workdir)
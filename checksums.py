@@ -0,0 +1,29 @@
+from __future__ import print_function
+import mmap
+import os
+import zlib
+
+chunk_size = 16*1024*1024
+
+def adler32_file(path):
+    value = 1
+    size = os.path.getsize(path)
+    if size == 0:
+        return "{0:08x}".format(value)
+    with open(path, "rb") as infile:
+        mapped = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            view = memoryview(mapped)
+            for start in range(0, size, chunk_size):
+                value = zlib.adler32(view[start:start+chunk_size], value)
+            view.release()
+        finally:
+            mapped.close()
+    return "{0:08x}".format(value & 0xffffffff)
+
+def same_checksum(a, b):
+    # gfal-sum may drop leading zeros
+    try:
+        return int(a, 16) == int(b, 16)
+    except (TypeError, ValueError):
+        return False
@@ -0,0 +1,136 @@
+from __future__ import print_function
+import heapq
+import itertools
+import multiprocessing.pool
+import threading
+import time
+
+# The executor whose job the current thread is running, if any
+_local = threading.local()
+
+def current_executor():
+    return getattr(_local, "executor", None)
+
+class PendingJob():
+    # Result of a submitted job, with the same get() as the pool's AsyncResult
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def set(self, result, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def get(self, timeout=None):
+        if not self.done.wait(timeout):
+            raise multiprocessing.TimeoutError()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+class AdaptiveExecutor():
+    # Runs jobs on a thread pool sized for the ceiling, but only lets `limit`
+    # of them run at once. The limit follows AIMD: it grows by one while the
+    # measured throughput keeps improving and halves on backoff(), which is
+    # called for timeouts and other transient errors. Jobs failing for other
+    # reasons (missing files, existing targets) say nothing about the load.
+    # Jobs can be submitted from any thread at any time and wait until a slot
+    # is free. With largest_first the waiting job with the largest weight
+    # gets the next slot, otherwise they run in the order submitted.
+    def __init__(self, ceiling, start=None, adaptive=True, min_window=0.5, observer=None,
+                 largest_first=False):
+        self.ceiling = max(ceiling, 1)
+        if start is None:
+            start = self.ceiling
+        self.limit = max(min(start, self.ceiling), 1)
+        self.adaptive = adaptive
+        self.min_window = min_window
+        self.observer = observer
+        self.largest_first = largest_first
+        self.waiting = []
+        self.counter = itertools.count()
+        self.pool = multiprocessing.pool.ThreadPool(processes=self.ceiling)
+        self.cond = threading.Condition()
+        self.running = 0
+        self.best_rate = None
+        self._new_window()
+
+    def _new_window(self):
+        self.window_start = time.time()
+        self.window_done = 0
+        self.window_weight = 0
+
+    def _acquire(self):
+        with self.cond:
+            while self.running >= self.limit:
+                self.cond.wait()
+            self.running += 1
+            if self.observer is not None:
+                self.observer(self.running, self.limit)
+
+    def _release(self, ok, weight):
+        with self.cond:
+            self.running -= 1
+            if self.adaptive:
+                self._adjust(ok, weight)
+            if self.observer is not None:
+                self.observer(self.running, self.limit)
+            self.cond.notify_all()
+
+    def backoff(self):
+        with self.cond:
+            if self.adaptive:
+                self.limit = max(self.limit//2, 1)
+                self.best_rate = None
+                self._new_window()
+            if self.observer is not None:
+                self.observer(self.running, self.limit)
+
+    def _adjust(self, ok, weight):
+        if not ok:
+            return
+        self.window_done += 1
+        self.window_weight += weight
+        elapsed = time.time()-self.window_start
+        if self.window_done < self.limit or elapsed < self.min_window:
+            return
+        rate = self.window_weight/elapsed
+        if self.best_rate is None or rate > self.best_rate*1.05:
+            self.best_rate = rate
+            self.limit = min(self.limit+1, self.ceiling)
+        self._new_window()
+
+    def _run_next(self):
+        # Every submit starts one of these, which takes whichever job is
+        # first in line once it has a slot
+        self._acquire()
+        with self.cond:
+            _, _, func, job, weight, pending = heapq.heappop(self.waiting)
+        ok = False
+        _local.executor = self
+        try:
+            result = func(*job)
+            ok = result is not False
+            pending.set(result)
+        except Exception as e:
+            pending.set(None, e)
+        finally:
+            _local.executor = None
+            self._release(ok, weight)
+
+    def submit(self, func, job, weight=1):
+        pending = PendingJob()
+        priority = -weight if self.largest_first else 0
+        with self.cond:
+            heapq.heappush(self.waiting, (priority, next(self.counter), func, job, weight, pending))
+        self.pool.apply_async(self._run_next)
+        return pending
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        self.pool.terminate()
@@ -22,3 +22,56 @@ protocol_mkdir = "gsiftp"
 dir_colour = 33
 exe_colour = 34
 use_fnmatch = False
+listing_threads = 8
+cache_file = os.path.expanduser("~/.cache/dpm-manager/listings.sqlite")
+cache_ttl = 300
+## gfal backend: "gfal2" python bindings, "cli" gfal-* commands, or "auto"
+## to use the bindings when they are installed
+backend = "auto"
+bulk_batch_size = 200
+bulk_retries = 2
+## No. of URLs per gfal-rm call when deleting
+delete_batch_size = 100
+## Without -j, copies, moves and deletions start with adaptive_start_threads
+## parallel operations and add more while throughput improves, backing off on
+## errors, up to these limits
+adaptive_start_threads = 4
+max_threads_copy = 32
+max_threads_move = 16
+max_threads_delete = 32
+## Copies are started largest first. Files of at least large_file_size bytes
+## are copied with large_file_streams parallel streams (--nbstreams), files
+## under small_file_size are downloaded small_file_batch at a time in one call
+large_file_size = 1024**3
+large_file_streams = 4
+small_file_size = 1024**2
+small_file_batch = 50
+## --verify compares checksums of copied files in batches of verify_batch_size,
+## up to max_threads_verify batches at once, and copies a file again up to
+## verify_attempts times if they differ
+verify_batch_size = 20
+max_threads_verify = 4
+verify_attempts = 2
+## Transient failures (timeouts, connection resets, busy servers) are retried
+## up to retry_attempts times with a random delay of up to
+## retry_base_delay*2**attempt seconds (capped at retry_max_delay). No more
+## than retry_budget retries are made in one run.
+retry_attempts = 3
+retry_base_delay = 2.0
+retry_max_delay = 60.0
+retry_budget = 500
+## gfal-* commands are run from one process, at most max_subprocesses at once.
+## A command still running after command_timeout seconds (copy_timeout for
+## gfal-copy, None for no limit) is killed and counts as a transient failure.
+## gfal-sum, gfal-rm -r and listings of huge directories can run for hours.
+## With --timeout, which gfal enforces itself, a command is also killed
+## timeout_grace seconds after gfal should have given up
+max_subprocesses = 256
+command_timeout = None
+copy_timeout = None
+timeout_grace = 60
+## Optional agent (gfal_helper.py --agent start) that keeps the backend and
+## listing threads warm between calls. It exits after agent_idle_timeout
+## seconds without a request
+agent_socket = os.path.expanduser("~/.cache/dpm-manager/agent.sock")
+agent_idle_timeout = 3600
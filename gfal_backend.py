@@ -0,0 +1,512 @@
+from __future__ import print_function
+import errno
+import os
+import random
+import re
+import stat
+import tempfile
+import threading
+import time
+
+try:
+    import gfal2
+except ImportError:
+    gfal2 = None
+
+backend_names = ["auto", "gfal2", "cli"]
+
+class GfalError(Exception):
+    # detail is what the tool itself said (stderr, or the gfal2 message), as
+    # opposed to the message, which also names the command and URLs
+    def __init__(self, message, code=None, detail=""):
+        super(GfalError, self).__init__(message, code)
+        self.message = message
+        self.code = code
+        self.detail = detail
+
+    def __str__(self):
+        return self.message
+
+transient_codes = set([errno.ETIMEDOUT, errno.ECONNRESET, errno.ECONNREFUSED,
+                       errno.ECONNABORTED, errno.EAGAIN, errno.EBUSY, errno.ECOMM,
+                       errno.EHOSTUNREACH, errno.ENETUNREACH, errno.ENETDOWN,
+                       errno.EPIPE, errno.ECANCELED])
+permanent_pattern = re.compile(
+    r"no such file|permission denied|operation not permitted|file exists|"
+    r"not a directory|is a directory|directory not empty|already exists", re.IGNORECASE)
+transient_pattern = re.compile(
+    r"timed? ?out|connection (reset|refused|closed|aborted)|temporarily unavailable|"
+    r"device or resource busy|server busy|too many|try again|broken pipe|"
+    r"network is unreachable|no route to host|communication error", re.IGNORECASE)
+
+missing_pattern = re.compile(r"no such file", re.IGNORECASE)
+
+def is_missing(error):
+    return error.code == errno.ENOENT or bool(missing_pattern.search(error.detail))
+
+def classify(error):
+    # Only the tool's own output and exit code count, a file called
+    # timeout_study.dat shouldn't make its failures look transient. The
+    # output is checked first: a "No such file" can come back with whatever
+    # exit code the tool felt like using
+    if permanent_pattern.search(error.detail):
+        return "permanent"
+    if error.code in transient_codes or transient_pattern.search(error.detail):
+        return "transient"
+    return "permanent"
+
+def _ls_date(mtime):
+    # Mimic ls -l: time of day for recent entries, year for older ones
+    if abs(time.time()-mtime) < 180*24*3600:
+        return time.strftime("%b %d %H:%M", time.localtime(mtime))
+    return time.strftime("%b %d  %Y", time.localtime(mtime))
+
+def _basename(url):
+    return url.rstrip("/").rsplit("/", 1)[-1]
+
+def _local_path(url):
+    if url.startswith("file://"):
+        return url[len("file://"):]
+    if "://" not in url:
+        return url
+    return None
+
+def _local_size(url):
+    path = _local_path(url)
+    if path is None or not os.path.isfile(path):
+        return 0
+    return os.path.getsize(path)
+
+def ls_line(name, st):
+    return "{0} {1:3} {2:5} {3:5} {4:12} {5} {6}".format(
+        stat.filemode(st.st_mode), st.st_nlink, st.st_uid, st.st_gid,
+        st.st_size, _ls_date(st.st_mtime), name)
+
+class CliBackend():
+    name = "cli"
+
+    def __init__(self, run_command, stream_command):
+        self.run_command = run_command
+        self.stream_command = stream_command
+
+    def _extra_args(self, args, transfer=False):
+        extra_args = []
+        if args.debug:
+            extra_args.append("-vvv")
+        if args.timeout is not None:
+            for i in ["-t", str(args.timeout), "-T", str(args.timeout)]:
+                extra_args.append(i)
+        if transfer:
+            if args.parent:
+                extra_args.append("-p")
+            if args.force:
+                extra_args.append("-f")
+        return extra_args
+
+    def _call(self, *cmd):
+        retcode, stdout, stderr = self.run_command(*cmd)
+        if retcode != 0:
+            raise GfalError("call {0} failed with non-zero error code {1}\n{2}".format(
+                " ".join(cmd), retcode, " ".join(stderr)), retcode, " ".join(stderr))
+        return stdout
+
+    def ls(self, url):
+        return self._call("gfal-ls", url, "-l")
+
+    def ls_iter(self, url):
+        call = self.stream_command("gfal-ls", url, "-l")
+        for line in call:
+            yield line
+        if call.returncode != 0:
+            raise GfalError("call gfal-ls {0} failed with non-zero error code {1}\n{2}".format(
+                url, call.returncode, " ".join(call.stderr)), call.returncode,
+                " ".join(call.stderr))
+
+    def copy(self, src, dst, args, streams=None):
+        extra_args = self._extra_args(args, transfer=True)
+        if streams is not None:
+            extra_args += ["--nbstreams", str(streams)]
+        self._call("gfal-copy", src, dst, *extra_args)
+
+    def copy_bulk(self, srcs, dst_dir, args):
+        # gfal-copy only reports an overall exit code for --from-file, so for
+        # local destinations each file is checked on disk afterwards.
+        errors = [None]*len(srcs)
+        local_dir = _local_path(dst_dir)
+        todo = []
+        for i, src in enumerate(srcs):
+            if local_dir is not None and not args.force and \
+               os.path.exists(os.path.join(local_dir, _basename(src))):
+                errors[i] = GfalError("{0} already exists in {1}".format(
+                    _basename(src), local_dir), errno.EEXIST)
+            else:
+                todo.append(i)
+        if len(todo) == 0:
+            return errors
+
+        start_time = time.time()
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as srcfile:
+            srcfile.write("\n".join(srcs[i] for i in todo)+"\n")
+        try:
+            retcode, stdout, stderr = self.run_command(
+                "gfal-copy", "--from-file", srcfile.name, dst_dir,
+                *self._extra_args(args, transfer=True))
+        finally:
+            os.remove(srcfile.name)
+
+        for i in todo:
+            if local_dir is not None:
+                target = os.path.join(local_dir, _basename(srcs[i]))
+                if os.path.exists(target) and os.path.getmtime(target) >= start_time-1:
+                    continue
+            elif retcode == 0:
+                continue
+            errors[i] = GfalError("copying {0} to {1} failed\n{2}".format(
+                srcs[i], dst_dir, " ".join(stderr)), retcode, " ".join(stderr))
+        return errors
+
+    def checksum(self, url, args, algorithm="ADLER32"):
+        stdout = self._call("gfal-sum", url, algorithm, *self._extra_args(args))
+        return stdout[-1].split()[-1]
+
+    def checksum_bulk(self, urls, args, algorithm="ADLER32"):
+        # gfal-sum takes one file, so start them all before reading any
+        calls = [self.stream_command("gfal-sum", url, algorithm, *self._extra_args(args))
+                 for url in urls]
+        results = []
+        for url, call in zip(urls, calls):
+            stdout = list(call)
+            if call.returncode != 0 or len(stdout) == 0:
+                results.append(GfalError("call gfal-sum {0} failed with non-zero error code "
+                                         "{1}\n{2}".format(url, call.returncode,
+                                                           " ".join(call.stderr)),
+                                         call.returncode, " ".join(call.stderr)))
+            else:
+                results.append(stdout[-1].split()[-1])
+        return results
+
+    def rm(self, url, args, recursive=False):
+        extra_args = self._extra_args(args)
+        if recursive:
+            extra_args.append("-r")
+        self._call("gfal-rm", url, *extra_args)
+
+    def rm_bulk(self, urls, args, recursive=False):
+        # gfal-rm reports each URL on stdout as "<url> DELETED" or "<url>
+        # MISSING", anything unreported failed if the call did
+        extra_args = self._extra_args(args)
+        if recursive:
+            extra_args.append("-r")
+        retcode, stdout, stderr = self.run_command("gfal-rm", *(extra_args+list(urls)))
+        statuses = {}
+        for line in stdout:
+            fields = line.split()
+            if len(fields) >= 2:
+                statuses[fields[0]] = fields[-1]
+        errors = []
+        for url in urls:
+            status = statuses.get(url)
+            if status == "DELETED" or (status is None and retcode == 0):
+                errors.append(None)
+            elif status == "MISSING":
+                errors.append(GfalError("deleting {0} failed: No such file or directory".format(
+                    url), errno.ENOENT))
+            else:
+                errors.append(GfalError("deleting {0} failed with error code {1}\n{2}".format(
+                    url, retcode, " ".join(stderr)), retcode, " ".join(stderr)))
+        return errors
+
+    def rename(self, old, new, args):
+        self._call("gfal-rename", old, new, *self._extra_args(args))
+
+    def mkdir(self, url, args):
+        self._call("gfal-mkdir", "-p", url, *self._extra_args(args))
+
+class Gfal2Backend():
+    name = "gfal2"
+
+    def __init__(self, debug=False):
+        self.local = threading.local()
+        if debug:
+            gfal2.set_verbose(gfal2.verbose_level.debug)
+
+    def context(self, args=None):
+        # One context per worker thread/process, reused for every operation
+        # so sessions and credentials are only set up once.
+        pid = os.getpid()
+        if getattr(self.local, "pid", None) != pid:
+            self.local.ctx = gfal2.creat_context()
+            self.local.pid = pid
+        ctx = self.local.ctx
+        if args is not None and args.timeout is not None:
+            ctx.set_opt_integer("CORE", "NAMESPACE_TIMEOUT", args.timeout)
+        return ctx
+
+    def _params(self, ctx, args, streams=None):
+        params = ctx.transfer_parameters()
+        params.overwrite = bool(args.force)
+        params.create_parent = bool(args.parent)
+        if args.timeout is not None:
+            params.timeout = args.timeout
+        if streams is not None:
+            params.nbstreams = streams
+        return params
+
+    def ls(self, url):
+        return list(self.ls_iter(url))
+
+    def ls_iter(self, url):
+        ctx = self.context()
+        try:
+            st = ctx.stat(url)
+            if not stat.S_ISDIR(st.st_mode):
+                yield ls_line(url, st)
+                return
+            directory = ctx.opendir(url)
+            while True:
+                dirent, st = directory.readpp()
+                if dirent is None:
+                    break
+                if dirent.d_name in (".", ".."):
+                    continue
+                yield ls_line(dirent.d_name, st)
+        except gfal2.GError as e:
+            raise GfalError("listing {0} failed: {1}".format(url, e.message), e.code, e.message)
+
+    def copy(self, src, dst, args, streams=None):
+        ctx = self.context(args)
+        try:
+            ctx.filecopy(self._params(ctx, args, streams), src, dst)
+        except gfal2.GError as e:
+            raise GfalError("copying {0} to {1} failed: {2}".format(src, dst, e.message), e.code,
+                            e.message)
+
+    def copy_bulk(self, srcs, dst_dir, args):
+        ctx = self.context(args)
+        dsts = ["{0}/{1}".format(dst_dir.rstrip("/"), _basename(i)) for i in srcs]
+        try:
+            errors = ctx.filecopy(self._params(ctx, args), srcs, dsts)
+        except gfal2.GError as e:
+            return [GfalError("copying {0} failed: {1}".format(i, e.message), e.code, e.message)
+                    for i in srcs]
+        return [None if e is None else
+                GfalError("copying {0} failed: {1}".format(src, e.message), e.code, e.message)
+                for src, e in zip(srcs, errors)]
+
+    def checksum(self, url, args, algorithm="ADLER32"):
+        ctx = self.context(args)
+        try:
+            return ctx.checksum(url, algorithm)
+        except gfal2.GError as e:
+            raise GfalError("checksum of {0} failed: {1}".format(url, e.message), e.code, e.message)
+
+    def checksum_bulk(self, urls, args, algorithm="ADLER32"):
+        results = []
+        for url in urls:
+            try:
+                results.append(self.checksum(url, args, algorithm))
+            except GfalError as e:
+                results.append(e)
+        return results
+
+    def _rm_tree(self, ctx, url):
+        directory = ctx.opendir(url)
+        while True:
+            dirent, st = directory.readpp()
+            if dirent is None:
+                break
+            if dirent.d_name in (".", ".."):
+                continue
+            child = "{0}/{1}".format(url.rstrip("/"), dirent.d_name)
+            if stat.S_ISDIR(st.st_mode):
+                self._rm_tree(ctx, child)
+            else:
+                ctx.unlink(child)
+        ctx.rmdir(url)
+
+    def rm(self, url, args, recursive=False):
+        ctx = self.context(args)
+        try:
+            if recursive and stat.S_ISDIR(ctx.stat(url).st_mode):
+                self._rm_tree(ctx, url)
+            else:
+                ctx.unlink(url)
+        except gfal2.GError as e:
+            raise GfalError("deleting {0} failed: {1}".format(url, e.message), e.code, e.message)
+
+    def rm_bulk(self, urls, args, recursive=False):
+        # No process to start per call, so there is nothing to batch
+        errors = []
+        for url in urls:
+            try:
+                self.rm(url, args, recursive=recursive)
+                errors.append(None)
+            except GfalError as e:
+                errors.append(e)
+        return errors
+
+    def rename(self, old, new, args):
+        ctx = self.context(args)
+        try:
+            ctx.rename(old, new)
+        except gfal2.GError as e:
+            raise GfalError("moving {0} to {1} failed: {2}".format(old, new, e.message), e.code,
+                            e.message)
+
+    def mkdir(self, url, args):
+        ctx = self.context(args)
+        try:
+            ctx.mkdir_rec(url, 0o755)
+        except gfal2.GError as e:
+            raise GfalError("creating {0} failed: {1}".format(url, e.message), e.code, e.message)
+
+class RetryingBackend():
+    # Wraps a backend so that transient failures are retried with jittered
+    # exponential backoff, while permanent ones (and transient ones that run
+    # out of attempts or of the run-wide retry budget) are recorded.
+    # on_transient is called on every transient failure, retried or not, to
+    # slow things down.
+    def __init__(self, backend, attempts, base_delay, max_delay, budget, warn=None,
+                 metrics=None, on_transient=None):
+        self.backend = backend
+        self.on_transient = on_transient
+        self.metrics = metrics
+        self.name = backend.name
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.warn = warn
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.failures = []
+
+    def _take_retry(self):
+        with self.lock:
+            if self.retries >= self.budget:
+                return False
+            self.retries += 1
+            return True
+
+    def _backoff(self, operation, url, error, attempt):
+        if self.metrics is not None:
+            self.metrics.record_retry(operation, url)
+        delay = random.uniform(0, min(self.max_delay, self.base_delay*2**attempt))
+        if self.warn is not None:
+            self.warn("{0} {1} failed ({2}), retrying in {3:.1f}s [{4}/{5}]".format(
+                operation, url, error.message.splitlines()[-1], delay, attempt+1, self.attempts))
+        time.sleep(delay)
+
+    def should_retry(self, error, attempt):
+        return attempt < self.attempts and classify(error) == "transient" and self._take_retry()
+
+    def record_failure(self, operation, url, error, attempts=1):
+        with self.lock:
+            self.failures.append({"operation": operation, "url": url,
+                                  "code": error.code, "kind": classify(error),
+                                  "attempts": attempts, "message": error.message})
+
+    def _record(self, operation, url, start_time, nbytes=0, ok=True):
+        if self.metrics is not None:
+            self.metrics.record(operation, url, time.time()-start_time, nbytes, ok)
+
+    def _call(self, operation, url, func, *args, **kwargs):
+        transferred = kwargs.pop("transferred", None)
+        missing_ok = kwargs.pop("missing_ok", False)
+        attempt = 0
+        while True:
+            start_time = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except GfalError as e:
+                self._record(operation, url, start_time, ok=False)
+                if self.on_transient is not None and classify(e) == "transient":
+                    # Before sleeping, so others slow down while this one waits
+                    self.on_transient()
+                if self.should_retry(e, attempt):
+                    self._backoff(operation, url, e, attempt)
+                    attempt += 1
+                    continue
+                if not (missing_ok and is_missing(e)):
+                    self.record_failure(operation, url, e, attempt+1)
+                raise
+            if self.metrics is not None:
+                nbytes = transferred(result) if transferred is not None else 0
+                self._record(operation, url, start_time, nbytes)
+            return result
+
+    def ls(self, url, missing_ok=False):
+        # With missing_ok a URL that doesn't exist gives None, not a failure
+        try:
+            return self._call("ls", url, self.backend.ls, url, missing_ok=missing_ok)
+        except GfalError as e:
+            if missing_ok and is_missing(e):
+                return None
+            raise
+
+    def ls_iter(self, url):
+        # Only a listing that fails before producing anything can be retried
+        attempt = 0
+        while True:
+            produced = False
+            start_time = time.time()
+            try:
+                for line in self.backend.ls_iter(url):
+                    produced = True
+                    yield line
+                self._record("ls", url, start_time)
+                return
+            except GfalError as e:
+                self._record("ls", url, start_time, ok=False)
+                if not produced and self.should_retry(e, attempt):
+                    self._backoff("ls", url, e, attempt)
+                    attempt += 1
+                    continue
+                self.record_failure("ls", url, e, attempt+1)
+                raise
+
+    def copy(self, src, dst, args, streams=None):
+        def transferred(result):
+            return _local_size(dst) or _local_size(src)
+        return self._call("copy", src, self.backend.copy, src, dst, args, streams=streams,
+                          transferred=transferred)
+
+    def copy_bulk(self, srcs, dst_dir, args):
+        # Per-file errors come back in the list and are left to the caller
+        def transferred(errors):
+            return sum(_local_size("{0}/{1}".format(dst_dir.rstrip("/"), _basename(src)))
+                       for src, error in zip(srcs, errors) if error is None)
+        return self._call("copy_bulk", srcs[0] if len(srcs) > 0 else dst_dir,
+                          self.backend.copy_bulk, srcs, dst_dir, args,
+                          transferred=transferred)
+
+    def checksum(self, url, args, algorithm="ADLER32"):
+        return self._call("checksum", url, self.backend.checksum, url, args, algorithm)
+
+    def checksum_bulk(self, urls, args, algorithm="ADLER32"):
+        # Per-URL errors come back in the list and are left to the caller
+        return self._call("checksum_bulk", urls[0] if len(urls) > 0 else "",
+                          self.backend.checksum_bulk, urls, args, algorithm)
+
+    def rm(self, url, args, recursive=False):
+        return self._call("rm", url, self.backend.rm, url, args, recursive=recursive)
+
+    def rm_bulk(self, urls, args, recursive=False):
+        # Per-URL errors come back in the list and are left to the caller
+        return self._call("rm_bulk", urls[0] if len(urls) > 0 else "", self.backend.rm_bulk,
+                          urls, args, recursive=recursive)
+
+    def rename(self, old, new, args):
+        return self._call("rename", old, self.backend.rename, old, new, args)
+
+    def mkdir(self, url, args):
+        return self._call("mkdir", url, self.backend.mkdir, url, args)
+
+def get_backend(name, run_command, stream_command, debug=False):
+    if name == "auto":
+        name = "gfal2" if gfal2 is not None else "cli"
+    if name == "gfal2":
+        if gfal2 is None:
+            raise GfalError("gfal2 python bindings are not available")
+        return Gfal2Backend(debug=debug)
+    return CliBackend(run_command, stream_command)
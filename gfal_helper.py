@@ -1,17 +1,38 @@
 #!/usr/bin/env python3
 from __future__ import print_function
+import agent
+import sys
+if __name__ == "__main__":
+    # Hand listings to a running agent before paying for the imports below
+    agent.forward_if_running(sys.argv[1:])
+import array
+import collections
 import config
+import copy
+import checksums
+import concurrency
 import datetime
+import errno
+import heapq
+import json
 import fnmatch
+import functools
+import gfal_backend
 import itertools
+import listing_cache
+import listing_output
 import lscp_args
 import multiprocessing as mp
+import multiprocessing.pool
 import os
+import process_supervisor
+import random
 import re
-import sre_constants
-import string
 import subprocess as sp
-import sys
+import threading
+import time
+import transfer_journal
+import transfer_metrics
 
 default_user = config.default_user
 file_count_reprint_no = config.file_count_reprint_no
@@ -26,7 +47,40 @@ DPM = pcol_def+config.DPM
 dir_colour = config.dir_colour
 exe_colour = config.exe_colour
 use_fnmatch = config.use_fnmatch
+bulk_retries = config.bulk_retries
+max_threads = {"copy": config.max_threads_copy,
+               "move": config.max_threads_move,
+               "delete": config.max_threads_delete,
+               "mkdir": config.max_threads_move,
+               "verify": config.max_threads_verify}
+adaptive_start_threads = config.adaptive_start_threads
+dpm_user = default_user
+args = None
+dir_cache = None
+backend = None
+supervisor = process_supervisor.ProcessSupervisor(config.max_subprocesses)
+matcher = None
+journals = {}
+executors = {}
+# Executors are also created from worker threads, e.g. verify by copies
+executors_lock = threading.Lock()
+queued_jobs = collections.deque()
+stale_listings = []
+created_dirs = set()
+move_targets = {}
+deletion_plan = None
+verifier = None
+runcard_index = None
+top_entries = None
+record_writer = None
+metrics = None
+refresh_listings = False
 debug = False
+listing_pool = None
+# Only set in the agent, which keeps these between requests
+agent_mode = False
+warm_backends = {}
+warm_cache = None
 
 def _wrap_str(string, colour):
     return "\033[{1}m{0}\033[0m".format(string, colour)
@@ -36,30 +90,108 @@ def debug_print(string):
         return
     print("{0} {1}".format(_wrap_str("DEBUG:", 36), string))
 
+def warning_print(string):
+    if string.strip() == "":
+        return
+    print("{0} {1}".format(_wrap_str("WARNING:", 33), string), file=sys.stderr)
+
 def error_print(string):
     if string.strip() == "":
         return
     print("{0} {1}".format(_wrap_str("ERROR:", 31), string), file=sys.stderr)
 
+month_numbers = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+                 "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+size_suffixes = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4, "P": 1024**5}
+
+def parse_size(size):
+    try:
+        if size[-1] in size_suffixes:
+            return int(float(size[:-1])*size_suffixes[size[-1]])
+        return int(size)
+    except (ValueError, IndexError):
+        return 0
+
+@functools.lru_cache(maxsize=4096)
+def parse_mtime(month, day, time_or_year):
+    # ls -l style dates: "Mar 18 12:00" within the last six months,
+    # "Mar 18  2019" otherwise
+    try:
+        month = month_numbers[month]
+        day = int(day)
+        if ":" in time_or_year:
+            hour, minute = [int(i) for i in time_or_year.split(":")]
+            now = datetime.datetime.now()
+            year = now.year
+            if datetime.datetime(year, month, day, hour, minute) > now+datetime.timedelta(days=1):
+                year -= 1
+        else:
+            year, hour, minute = int(time_or_year), 0, 0
+        return time.mktime((year, month, day, hour, minute, 0, 0, 0, -1))
+    except (KeyError, ValueError):
+        return 0.0
+
 class DPMFile():
+    # One of these is kept per listed entry, so only the raw gfal-ls line is
+    # stored and the columns are split out when they are first needed.
+    __slots__ = ("line", "directory", "_fname", "_fields")
+
     def __init__(self, line, directory):
+        self.line = line
         self.directory = directory
-        self.fname = line.strip()
-        self.__split = [x.strip() for x in line.split()]
-        self.fname = self.__split[-1]
-        if self.directory == self.fname:
-            self.fname = os.path.basename(self.fname)
-            self.directory = os.path.dirname(self.directory)
-        self.fname_print = self.fname
-
-        self.time = self.__split[-2]
-        self.month = self.__split[-4]
-        self.day = self.__split[-3]
-        self.permissions = self.__split[0]
-        if self.permissions[0]=="d":
-            self.is_dir = True
-        else:
-            self.is_dir = False
+        self._fields = None
+        fname = line.rsplit(None, 1)[-1]
+        if directory == fname:
+            fname = os.path.basename(fname)
+            self.directory = os.path.dirname(directory)
+        self._fname = fname
+
+    def _split(self):
+        if self._fields is None:
+            ln = self.line.split()
+            self._fields = (parse_size(ln[-5]), ln[-4], ln[-3], ln[-2])
+        return self._fields
+
+    @property
+    def fname(self):
+        return self._fname
+
+    @property
+    def permissions(self):
+        return self.line.split(None, 1)[0]
+
+    @property
+    def is_dir(self):
+        return self.line[0] == "d"
+
+    @property
+    def size(self):
+        return self._split()[0]
+
+    @property
+    def month(self):
+        return self._split()[1]
+
+    @property
+    def day(self):
+        return self._split()[2]
+
+    @property
+    def time(self):
+        return self._split()[3]
+
+    @property
+    def mtime(self):
+        size, month, day, time_or_year = self._split()
+        return parse_mtime(month, day, time_or_year)
+
+    def record(self):
+        # (url, name, size, mtime, permissions, is_dir) for --format, from a
+        # single split of the line
+        size, month, day, time_or_year = self._split()
+        return (self.directory.rstrip("/")+"/"+self._fname, self._fname, size,
+                int(parse_mtime(month, day, time_or_year)), self.line.split(None, 1)[0],
+                self.line[0] == "d")
 
     def full_name(self, protocol=pcol_def):
         return os.path.join(self.dir(protocol), self.file())
@@ -71,13 +203,13 @@ class DPMFile():
         return self.fname
 
     def return_line_as_str(self, args):
-        ln = self.__split
-
+        fname_print = self.fname
+        permissions = self.permissions
         if not args.bare:
-            if self.permissions[0]=="d":
-                self.fname_print = _wrap_str(self.fname, dir_colour)
-            elif "x" in self.permissions:
-                self.fname_print = _wrap_str(self.fname, exe_colour)
+            if permissions[0]=="d":
+                fname_print = _wrap_str(self.fname, dir_colour)
+            elif "x" in permissions:
+                fname_print = _wrap_str(self.fname, exe_colour)
 
         retstr = ""
 
@@ -85,58 +217,137 @@ class DPMFile():
             retstr += "{0} {1} {2:15}".format(self.month, self.day,
                                            self.time)
         if args.permissions:
-            retstr += " {0:10} ".format(self.permissions)
+            retstr += " {0:10} ".format(permissions)
 
-        retstr += "{0:50}".format(self.fname_print)
+        retstr += "{0:50}".format(fname_print)
 
         if args.bare:
             retstr = " ".join(retstr.split())
         return retstr
 
     def __repr__(self):
-        ln = self.__split
-        return "{6:4e5} {0} {1} {4} {5:17} No. files: {2:7}  {3}".format(self.time, ln[1], ln[0],*ln[-4:])
-
-def bash_call(*args, **kwargs):
+        return "DPMFile({0!r}, {1!r})".format(self.line, self.directory)
+
+def command_timeout(cmd):
+    # Copies get their own limit, they are usually the longest. gfal is
+    # given --timeout itself, so a child still running well after that is
+    # stuck
+    limits = [config.copy_timeout if cmd == "gfal-copy" else config.command_timeout]
+    if args is not None and args.timeout is not None:
+        limits.append(args.timeout+config.timeout_grace)
+    limits = [i for i in limits if i is not None]
+    return min(limits) if limits else None
+
+def run_command(*args, **kwargs):
     if debug:
         debug_print("<call> "+" ".join(args))
-    child = sp.Popen(args, stdout=sp.PIPE, stderr=sp.PIPE,
-                     **kwargs)
-    stdout, stderr = [i.split(b"\n") for i in child.communicate()]
+    timeout = kwargs.pop("timeout", command_timeout(args[0]))
+    retcode, stdout, stderr = supervisor.run(args, timeout=timeout, **kwargs)
 
     if debug:
         for i in stdout:
-            debug_print(i.decode("utf-8"))
-
-    if child.returncode != 0:
-        error_print("call {0} failed with non-zero error code {1}".format(" ".join(args), child.returncode))
-        error_print(" ".join(i.decode("utf-8") for i in stderr))
-    elif debug:
+            debug_print(i)
         for i in stderr:
-            debug_print(i.decode("utf-8"))
-
-    return [f.decode('utf-8') for f in stdout
-            if f != b""]
-
-def get_extra_args(args):
-    extra_args = []
-    if args.debug:
-        extra_args.append("-vvv")
-    if args.timeout is not None:
-        for i in ["-t", str(args.timeout), "-T", str(args.timeout)]:
-            extra_args.append(i)
-
-    if args.copy or args.copy_to_grid:
-        if args.parent:
-            extra_args.append("-p")
-        if args.force:
-            extra_args.append("-f")
-    return extra_args
-
-def get_usable_threads(no_threads, no_files):
-    return max(min(no_threads, no_files), 1)
-
-def copy_file_to_grid(infile, griddir, file_no, no_files, args):
+            debug_print(i)
+
+    return (retcode, [f for f in stdout if f != ""], [f for f in stderr if f != ""])
+
+class StreamedCall():
+    def __init__(self, *args, **kwargs):
+        if debug:
+            debug_print("<call> "+" ".join(args))
+        self.args = args
+        self.returncode = None
+        self.stderr = []
+        timeout = kwargs.pop("timeout", command_timeout(args[0]))
+        self.stream = supervisor.stream(args, timeout=timeout, **kwargs)
+
+    def __iter__(self):
+        for line in self.stream:
+            if debug:
+                debug_print(line)
+            if line != "":
+                yield line
+        self.returncode = self.stream.returncode
+        self.stderr = [i for i in self.stream.stderr if i != ""]
+        if debug:
+            for i in self.stderr:
+                debug_print(i)
+
+def stream_command(*args, **kwargs):
+    return StreamedCall(*args, **kwargs)
+
+def get_executor(operation, args):
+    # One executor per kind of operation for the whole run, so work from
+    # every directory shares the same threads and concurrency limit. -j pins
+    # the concurrency, otherwise it adapts up to the ceiling in config.py.
+    # Copies are weighted by size and the largest waiting goes first, so a
+    # big file isn't left to run on its own at the end
+    with executors_lock:
+        if operation not in executors:
+            observer = metrics.sample_concurrency if metrics is not None else None
+            if args.no_threads is not None:
+                executors[operation] = concurrency.AdaptiveExecutor(
+                    max(args.no_threads, 1), adaptive=False, observer=observer,
+                    largest_first=(operation == "copy"))
+            else:
+                executors[operation] = concurrency.AdaptiveExecutor(
+                    max_threads[operation], start=adaptive_start_threads, observer=observer,
+                    largest_first=(operation == "copy"))
+        return executors[operation]
+
+def back_off_current():
+    # A transient error in a job halves the concurrency of the executor
+    # running it; listings and the main thread have none
+    executor = concurrency.current_executor()
+    if executor is not None:
+        executor.backoff()
+
+def submit_jobs(operation, func, jobs, args, weights=None):
+    executor = get_executor(operation, args)
+    return [executor.submit(func, job, 1 if weights is None else weights[no])
+            for no, job in enumerate(jobs)]
+
+def queue_jobs(operation, func, jobs, args, weights=None):
+    # Returns straight away, wait_for_queued_jobs collects the results
+    queued_jobs.extend(submit_jobs(operation, func, jobs, args, weights))
+
+def run_parallel(operation, func, jobs, args, weights=None):
+    return [i.get() for i in submit_jobs(operation, func, jobs, args, weights)]
+
+def forget_listing_later(directory):
+    # Listings changed by queued jobs are only dropped once they have run
+    stale_listings.append(directory)
+
+def wait_for_queued_jobs():
+    # Verifying can queue copies again, which can queue more to verify
+    while True:
+        while queued_jobs:
+            queued_jobs.popleft().get()
+        if verifier is None or not verifier.flush():
+            break
+    while stale_listings:
+        forget_listing(stale_listings.pop())
+
+def shutdown_executors(abort=False):
+    # Jobs still finishing can create another executor, so go round until
+    # every one has been closed
+    closed = set()
+    while True:
+        with executors_lock:
+            remaining = [i for i in executors if i not in closed]
+        if len(remaining) == 0:
+            break
+        for operation in remaining:
+            if abort:
+                executors[operation].terminate()
+            else:
+                executors[operation].close()
+            closed.add(operation)
+    with executors_lock:
+        executors.clear()
+
+def copy_file_to_grid(infile, griddir, file_no, no_files, args, verify_attempt=0):
     infile_loc, infile_name = os.path.split(infile)
     infile = os.path.join(os.getcwd(), infile)
     lcgname = os.path.join(DPM.replace(pcol_def, pcol_up, 1), griddir, infile_name)
@@ -144,101 +355,428 @@ def copy_file_to_grid(infile, griddir, file_no, no_files, args):
     filename = "file://{0}".format(infile)
     print("Copying {0} to {1} [{2}/{3}]".format(filename, lcgname,
                                                 file_no+1, no_files))
-
-    extra_args = get_extra_args(args)
-
-    bash_call("gfal-copy", filename, lcgname, *extra_args)
+    try:
+        size = os.path.getsize(infile)
+    except OSError as e:
+        # Removed since the upload list was made
+        error_print("{0}: {1}".format(infile, e.strerror))
+        return False
+    try:
+        backend.copy(filename, lcgname, args, streams=transfer_streams(size, args))
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return False
+    if verifier is not None:
+        def retry():
+            # The bad copy on the grid has to be overwritten
+            force_args = copy.copy(args)
+            force_args.force = True
+            queue_jobs("copy", copy_file_to_grid,
+                       [(infile, griddir, file_no, no_files, force_args, verify_attempt+1)], args,
+                       weights=[size])
+        verifier.add(VerifyItem(infile, lcgname, verify_attempt, retry, None))
+    return True
 
 def delete_file_from_grid(xfile, file_no, no_files, args):
     lcgname = xfile.full_name(pcol_rm)
 
     print("Deleting {0} [{1}/{2}]".format(lcgname, file_no+1, no_files))
-    extra_args = get_extra_args(args)
+    try:
+        backend.rm(lcgname, args, recursive=xfile.is_dir)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return False
+    return True
 
-    if xfile.is_dir:
-        extra_args.append("-r")
+def transfer_streams(size, args):
+    if size >= config.large_file_size and args.nbstreams > 1:
+        return args.nbstreams
+    return None
 
-    retval = bash_call("gfal-rm", lcgname, *extra_args)
+def copy_DPM_file_to_local(DPMfile, localfile, args, size=0):
+    try:
+        backend.copy(DPMfile, localfile, args, streams=transfer_streams(size, args))
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return False
+    return True
 
-def copy_DPM_file_to_local(DPMfile, localfile, args):
-    extra_args = get_extra_args(args)
-    bash_call("gfal-copy", DPMfile, localfile, *extra_args)
+def get_journal(outdir):
+    if outdir not in journals:
+        journals[outdir] = transfer_journal.TransferJournal(outdir)
+    return journals[outdir]
 
-def copy_to_dir(infile, args, file_no, no_files):
-    lcgname = infile.full_name(pcol_down)
+def get_outdir(args):
     if args.output_directory is not None:
-        xfile = os.path.join(args.output_directory, infile.fname)
-    else:
-        xfile = os.path.join(os.getcwd(), infile.fname)
+        return args.output_directory
+    return os.getcwd()
+
+def local_copy_status(infile, xfile, args):
+    # "missing": copy as normal, "identical": nothing to do, "partial": left
+    # behind by an interrupted run so safe to replace, "different": someone
+    # else's file, only replaced with -f
+    if args.force or not os.path.exists(xfile):
+        return "missing"
+    journal = get_journal(os.path.dirname(xfile))
+    lcgname = infile.full_name(pcol_down)
+    local_size = os.path.getsize(xfile)
+    if local_size != infile.size:
+        return "partial" if journal.is_partial(infile.fname) else "different"
+    if not args.checksum:
+        return "identical"
+    local_mtime = os.path.getmtime(xfile)
+    local_sum = journal.known_checksum(infile.fname, lcgname, local_size, local_mtime)
+    if local_sum is None:
+        local_sum = checksums.adler32_file(xfile)
+    try:
+        remote_sum = backend.checksum(lcgname, args)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return "partial" if journal.is_partial(infile.fname) else "different"
+    if checksums.same_checksum(local_sum, remote_sum):
+        journal.completed(infile.fname, lcgname, local_size, local_mtime, local_sum)
+        return "identical"
+    error_print("Checksum mismatch for {0}: local {1}, remote {2}".format(xfile, local_sum, remote_sum))
+    return "partial" if journal.is_partial(infile.fname) else "different"
+
+# A copied file waiting to be verified. retry copies it again, verified is
+# given the checksum once it has been checked
+VerifyItem = collections.namedtuple("VerifyItem",
+                                    ["local_path", "url", "attempt", "retry", "verified"])
+
+class Verifier():
+    # Collects copied files from the copy workers and hands them to the
+    # verify executor in batches, so remote checksums are looked up together
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def add(self, item):
+        with self.lock:
+            self.pending.append(item)
+            if len(self.pending) < config.verify_batch_size:
+                return
+            batch, self.pending = self.pending, []
+        queue_jobs("verify", verify_batch, [(batch, self.args)], self.args,
+                   weights=[len(batch)])
+
+    def flush(self):
+        # Returns whether anything was left to queue
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if len(batch) == 0:
+            return False
+        queue_jobs("verify", verify_batch, [(batch, self.args)], self.args,
+                   weights=[len(batch)])
+        return True
+
+def verify_batch(batch, args):
+    try:
+        remote_sums = backend.checksum_bulk([i.url for i in batch], args)
+    except gfal_backend.GfalError as e:
+        remote_sums = [e]*len(batch)
+    ok = True
+    for item, remote_sum in zip(batch, remote_sums):
+        if isinstance(remote_sum, gfal_backend.GfalError):
+            error_print("Could not verify {0}: {1}".format(item.local_path, remote_sum.message))
+            ok = False
+            continue
+        local_sum = checksums.adler32_file(item.local_path)
+        if checksums.same_checksum(local_sum, remote_sum):
+            print("Verified {0} ({1})".format(item.local_path, local_sum))
+            if item.verified is not None:
+                item.verified(local_sum)
+            continue
+        ok = False
+        error = gfal_backend.GfalError("Checksum mismatch for {0}: local {1}, remote {2}".format(
+            item.local_path, local_sum, remote_sum))
+        if item.attempt < config.verify_attempts:
+            error_print(error.message+", copying it again")
+            item.retry()
+        else:
+            error_print(error.message)
+            backend.record_failure("verify", item.url, error, item.attempt+1)
+    return ok
+
+def copy_to_dir(infile, args, file_no, no_files, outdir=None, verify_attempt=0):
+    lcgname = infile.full_name(pcol_down)
+    if outdir is None:
+        outdir = get_outdir(args)
+    xfile = os.path.join(outdir, infile.fname)
+    status = local_copy_status(infile, xfile, args)
+    if status == "identical":
+        print("Skipping {0}, already copied [{1}/{2}]".format(xfile, file_no+1, no_files))
+        return True
+    if status == "different":
+        error_print("{0} already exists and differs from {1}. Use -f to overwrite it".format(
+            xfile, lcgname))
+        return False
+    if status == "partial":
+        os.remove(xfile)
     print("Copying {0} to {1} [{2}/{3}]".format(lcgname, xfile,
                                                 file_no+1, no_files))
-    copy_DPM_file_to_local(lcgname, xfile, args)
+    journal = get_journal(outdir)
+    journal.started(infile.fname, lcgname, infile.size)
+    if not copy_DPM_file_to_local(lcgname, "file://"+os.path.abspath(xfile), args, infile.size):
+        return False
+    journal.completed(infile.fname, lcgname, infile.size, os.path.getmtime(xfile))
+    verify_download(infile, xfile, outdir, args, verify_attempt)
+    return True
 
-def move_to_dir(infile, args, file_no, no_files):
-    if infile.is_dir:  # Don't move directories for now
+def verify_download(infile, xfile, outdir, args, verify_attempt=0):
+    if verifier is None:
         return
-    _from, _to = args.directories
+    lcgname = infile.full_name(pcol_down)
+
+    def retry():
+        os.remove(xfile)
+        queue_jobs("copy", copy_to_dir, [(infile, args, 0, 1, outdir, verify_attempt+1)], args,
+                   weights=[infile.size])
+
+    def verified(checksum):
+        get_journal(outdir).completed(infile.fname, lcgname, infile.size,
+                                      os.path.getmtime(xfile), checksum)
+
+    verifier.add(VerifyItem(xfile, lcgname, verify_attempt, retry, verified))
+
+def copy_batch_to_dir(batch, args):
+    outdir = get_outdir(args)
+    journal = get_journal(outdir)
+    srcs = [f.full_name(pcol_down) for f in batch]
+    for f, src in zip(batch, srcs):
+        journal.started(f.fname, src, f.size)
+    try:
+        errors = backend.copy_bulk(srcs, "file://"+os.path.abspath(outdir), args)
+    except gfal_backend.GfalError as e:
+        errors = [e]*len(batch)
+    errors = list(errors)
+    for i, (f, src, error) in enumerate(zip(batch, srcs, errors)):
+        if error is None:
+            xfile = os.path.join(outdir, f.fname)
+            local_size = os.path.getsize(xfile)
+            if local_size != f.size:
+                # Left by an earlier failed run, the journal keeps it partial
+                errors[i] = gfal_backend.GfalError(
+                    "copying {0} to {1} gave {2} bytes, expected {3}".format(
+                        src, xfile, local_size, f.size), errno.EIO)
+                continue
+            journal.completed(f.fname, src, f.size, os.path.getmtime(xfile))
+            verify_download(f, xfile, outdir, args)
+    return errors
+
+def move_to_dir(infile, args, file_no, no_files, target_dir):
+    # Directories are renamed whole, server side
     oldlcgname = infile.full_name(pcol_mv)
     newlcgname = "{0}{1}".format( DPM.replace(pcol_def, pcol_mv, 1),
-                                    os.path.join(_to, infile.fname) )
+                                    os.path.join(target_dir, infile.fname) )
 
-    infile_dir = os.path.join(_from, infile.fname)
-    outfile_dir = os.path.join(_to, infile.fname)
-    print("Moving {0} from {1} to {2} [{3}/{4}]".format(infile.fname, _from, _to,
+    source_dir = infile.dir().replace(DPM, "", 1)
+    print("Moving {0} from {1} to {2} [{3}/{4}]".format(infile.fname, source_dir, target_dir,
                                                 file_no+1, no_files))
-    extra_args = get_extra_args(args)
-    bash_call("gfal-rename", oldlcgname, newlcgname, *extra_args)
+    try:
+        backend.rename(oldlcgname, newlcgname, args)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return False
+    return True
 
 def create_dir(directory, args):
-    extra_args = get_extra_args(args)
-    bash_call("gfal-mkdir", "-p", "{0}{1}".format( DPM.replace(pcol_def, pcol_mkdir, 1), directory), *extra_args)
-
-def _search_match(search_str, fileobj, args):
-    if args.wildcards:
+    try:
+        backend.mkdir("{0}{1}".format( DPM.replace(pcol_def, pcol_mkdir, 1), directory), args)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return False
+    return True
+
+class FileMatcher():
+    # All search/reject/exclude patterns are compiled once into a regex per
+    # role, so each entry is checked with a single regex call per role.
+    def __init__(self, args):
+        self.args = args
+        self.flags = re.DOTALL
+        if args.case_insensitive:
+            self.flags |= re.IGNORECASE
+        self.search = self._compile(args.search, match_all=True)
+        self.reject = self._compile(args.reject)
+        self.exclude = self._compile(args.exclude)
+
+    def _to_regex(self, pattern):
+        if not self.args.wildcards:
+            return re.escape(pattern)
         if use_fnmatch:
-            return fnmatch.fnmatch(search_str, fileobj.fname)
+            return r"\A"+fnmatch.translate(pattern)
+        return pattern
+
+    def _compile(self, patterns, match_all=False):
+        if patterns is None or len(patterns) == 0:
+            return None
+        regexes = [self._to_regex(i) for i in patterns]
         try:
-            if re.search(search_str, fileobj.fname) is not None:
-                return True
-            else:
-                return False
-        except sre_constants.error:
+            single = [re.compile(i, self.flags) for i in regexes]
+        except re.error:
             print(_wrap_str("Invalid regexp entered. Don't be silly.", 31))
             sys.exit(-1)
-    else:
-        if args.case_insensitive:
-            return search_str.upper() in fileobj.fname.upper()
-        else:
-            return search_str in fileobj.fname
+        if len(single) == 1:
+            return single[0].search
+        # Combining would renumber the user's groups and break backreferences
+        if all(i.groups == 0 for i in single):
+            if match_all:
+                # Each lookahead scans the whole name, so the order doesn't matter
+                combined = "".join("(?=.*?(?:{0}))".format(i) for i in regexes)
+            else:
+                combined = "|".join("(?:{0})".format(i) for i in regexes)
+            try:
+                if match_all:
+                    return re.compile(combined, self.flags).match
+                return re.compile(combined, self.flags).search
+            except re.error:
+                # e.g. inline flags like (?i), which are only allowed at the start
+                pass
+        if match_all:
+            return lambda name: all(i.search(name) for i in single)
+        return lambda name: any(i.search(name) for i in single)
+
+    def selects(self, fileobj):
+        name = fileobj.fname
+        if self.search is not None and not self.search(name):
+            return False
+        if self.reject is not None and self.reject(name):
+            return False
+        return True
 
-def is_excluded(fobj, args):
-    if args.exclude is None:
-        return False
-    else:
-        for search_str in args.exclude:
-            matched =  _search_match(search_str, fobj, args)
-            if matched:
-                return True
-    return False
+    def excludes(self, fileobj):
+        return self.exclude is not None and bool(self.exclude(fileobj.fname))
 
-def do_search(files, args):
-    for search_str in args.search:
-        files = [x for x in files if _search_match(search_str, x, args)]
-    return files
+def get_matcher(args):
+    global matcher
+    if matcher is None or matcher.args is not args:
+        matcher = FileMatcher(args)
+    return matcher
 
-def do_reject(files, args):
-    for rej_str in args.reject:
-        files = [x for x in files if not _search_match(rej_str, x, args)]
-    return files
+def is_excluded(fobj, args):
+    return get_matcher(args).excludes(fobj)
+
+def select_files(files, args, dir_only=False):
+    selects = get_matcher(args).selects
+    for x in files:
+        if dir_only and not x.is_dir:
+            continue
+        if selects(x):
+            yield x
 
 def do_copy(DPMdirectory, args, files):
+    get_journal(get_outdir(args))
+    if args.bulk:
+        return do_bulk_copy(DPMdirectory, args, files)
+    files = [f for f in files if not f.is_dir]
     no_files = len(files)
+    if no_files == 0:
+        return
     print("> Copying {0} file{1}...".format(no_files,
                                             ("" if no_files == 1 else "s")))
-    pool = mp.Pool(processes=get_usable_threads(args.no_threads, no_files))
-    pool.starmap(copy_to_dir, zip(files, itertools.repeat(args),
-                                  range(len(files)),
-                                  itertools.repeat(no_files)), chunksize=1)
+    small = [file_no for file_no, f in enumerate(files)
+             if f.size < config.small_file_size]
+    if len(small) < 2:
+        small = []
+    batch_size = max(config.small_file_batch, 1)
+    batches = [small[i:i+batch_size] for i in range(0, len(small), batch_size)]
+    queue_jobs("copy", copy_small_files,
+               [([(files[i], i) for i in batch], args, no_files) for batch in batches],
+               args, weights=[sum(files[i].size for i in batch) for batch in batches])
+    small = set(small)
+    others = [file_no for file_no in range(no_files) if file_no not in small]
+    queue_jobs("copy", copy_to_dir,
+               [(files[i], args, i, no_files) for i in others],
+               args, weights=[files[i].size for i in others])
+
+def copy_small_files(batch, args, no_files):
+    # Tiny files are dominated by the cost of each call, so they are
+    # fetched together. Anything that is already there or fails with a
+    # transient error goes back in the queue to be handled on its own.
+    # batch: (file, file_no) pairs
+    outdir = get_outdir(args)
+    pending = []
+    for f, file_no in batch:
+        if local_copy_status(f, os.path.join(outdir, f.fname), args) == "missing":
+            pending.append((f, file_no))
+        else:
+            queue_jobs("copy", copy_to_dir, [(f, args, file_no, no_files)], args,
+                       weights=[f.size])
+    if len(pending) == 0:
+        return True
+    numbers = format_ranges(sorted(file_no+1 for f, file_no in pending), separator=",",
+                            limit=None)
+    print("Copying {0} small files to {1} [{2}/{3}]".format(len(pending), outdir, numbers,
+                                                            no_files))
+    ok = True
+    for (f, file_no), error in zip(pending, copy_batch_to_dir([i[0] for i in pending], args)):
+        if error is None:
+            continue
+        ok = False
+        if gfal_backend.classify(error) == "permanent":
+            error_print(error.message)
+            backend.record_failure("copy", f.full_name(pcol_down), error)
+        else:
+            queue_jobs("copy", copy_to_dir, [(f, args, file_no, no_files)], args,
+                       weights=[f.size])
+    return ok
+
+def do_bulk_copy(DPMdirectory, args, files):
+    files = [f for f in files if not f.is_dir]
+    no_files = len(files)
+    batch_size = max(args.batch_size, 1)
+    outdir = get_outdir(args)
+    pending = []
+    copied = 0
+    for f in files:
+        xfile = os.path.join(outdir, f.fname)
+        status = local_copy_status(f, xfile, args)
+        if status == "identical":
+            copied += 1
+            continue
+        if status == "different":
+            error_print("{0} already exists and differs from {1}. Use -f to overwrite it".format(
+                xfile, f.full_name(pcol_down)))
+            continue
+        if status == "partial":
+            os.remove(xfile)
+        pending.append(f)
+    if copied > 0:
+        print("> Skipping {0} file{1} already copied".format(copied, ("" if copied == 1 else "s")))
+    if len(pending) == 0:
+        return
+    print("> Copying {0} file{1} in batches of {2}...".format(
+        len(pending), ("" if len(pending) == 1 else "s"), batch_size))
+    for attempt in range(bulk_retries+1):
+        if attempt > 0:
+            print("> Retrying {0} failed file{1}...".format(
+                len(pending), ("" if len(pending) == 1 else "s")))
+            time.sleep(random.uniform(0, min(config.retry_max_delay,
+                                              config.retry_base_delay*2**(attempt-1))))
+        batches = [pending[i:i+batch_size] for i in range(0, len(pending), batch_size)]
+        failed = []
+        results = run_parallel("copy", copy_batch_to_dir, [(i, args) for i in batches], args,
+                               weights=[sum(f.size for f in i) for i in batches])
+        for batch, errors in zip(batches, results):
+            for f, error in zip(batch, errors):
+                if error is None:
+                    copied += 1
+                    print("Copied {0} [{1}/{2}]".format(f.fname, copied, no_files))
+                elif gfal_backend.classify(error) == "permanent":
+                    # Retrying won't help, report it straight away
+                    error_print(error.message)
+                    backend.record_failure("copy", f.full_name(pcol_down), error)
+                else:
+                    failed.append((f, error))
+        pending = [f for f, error in failed]
+        if len(pending) == 0:
+            break
+    for f, error in failed:
+        error_print(error.message)
+        backend.record_failure("copy", f.full_name(pcol_down), error, bulk_retries+1)
+    if copied < no_files:
+        error_print("{0} of {1} files could not be copied".format(no_files-copied, no_files))
 
 def do_move(DPMdirectory, args, files):
     try:
@@ -246,102 +784,595 @@ def do_move(DPMdirectory, args, files):
     except AssertionError as e:
         error_print("Cannot perform move of files between directories. {0} specified".format(len(args.directories)))
         return
+    _from, _to = args.directories
+    target_dir = move_target(DPMdirectory, args)
+    # The target can't go inside itself
+    files = [f for f in files
+             if not (f.is_dir and is_inside(_to, os.path.join(DPMdirectory, f.fname)))]
+    # Directories being merged into existing ones are walked instead
+    merged = [f for f in files if f.is_dir and not is_moved_whole(f, args)]
+    if len(merged) > 0 and not args.recursive:
+        warning_print("{0} already in {1}, use -rc to merge into {2}".format(
+            ", ".join(f.fname for f in merged), target_dir,
+            ("it" if len(merged) == 1 else "them")))
+    files = [f for f in files if not f.is_dir or is_moved_whole(f, args)]
     no_files = len(files)
-    print("> Moving {0} file{1}...".format(no_files,
-                                            ("" if no_files == 1 else "s")))
-    create_dir(args.directories[1], args)
-    pool = mp.Pool(processes=get_usable_threads(args.no_threads, no_files))
-    pool.starmap(move_to_dir, zip(files, itertools.repeat(args),
-                                  range(len(files)),
-                                  itertools.repeat(no_files)), chunksize=1)
+    if no_files == 0:
+        return
+    print("> Moving {0} entr{1}...".format(no_files,
+                                            ("y" if no_files == 1 else "ies")))
+    if target_dir not in created_dirs:
+        if not create_dir(target_dir, args):
+            return
+        created_dirs.add(target_dir)
+    queue_jobs("move", move_to_dir,
+               [(f, args, file_no, no_files, target_dir) for file_no, f in enumerate(files)],
+               args)
+    forget_listing_later(DPMdirectory)
+    forget_listing_later(target_dir)
+
+def is_inside(path, root):
+    root, path = root.strip("/"), path.strip("/")
+    return root == "" or path == root or path.startswith(root+"/")
+
+def move_target(DPMdirectory, args):
+    # With -rc the layout below the source is recreated under the target, but
+    # only for directories that have something moved into them
+    _from, _to = args.directories
+    relative = _relative_to(_from, DPMdirectory)
+    return os.path.join(_to, relative) if relative != "" else _to
 
-def do_delete(DPMdirectory, files, args):
-    no_files = len(files)
-    query_str = "Do you really want to delete {1} {0} file{2} [y/n]?\n".format(
-        no_files,
-        ("this" if no_files == 1 else "these"),
-        ("" if no_files == 1 else "s"))
-    deletion_confirmed = get_yes_no(input(query_str))
-    if deletion_confirmed:
-        print("> Deleting files...")
-        pool = mp.Pool(processes=get_usable_threads(args.no_threads, no_files))
-        pool.starmap(delete_file_from_grid, zip(files,
-                                                range(len(files)),
-                                                itertools.repeat(no_files),
-                                                itertools.repeat(args)),
-                     chunksize=1)
+def move_target_names(target_dir):
+    # What is already in a target directory, nothing if it doesn't exist yet
+    if target_dir not in move_targets:
+        url = "{0}{1}".format(DPM.replace(pcol_def, pcol_ls, 1), target_dir)
+        try:
+            lines = backend.ls(url, missing_ok=True)
+        except gfal_backend.GfalError as e:
+            error_print(e.message)
+            lines = None
+        move_targets[target_dir] = set(DPMFile(x, url).fname for x in (lines or []))
+    return move_targets[target_dir]
+
+def is_moved_whole(fobj, args):
+    # A selected directory is renamed in one go unless the target already has
+    # one of that name, in which case the two are merged entry by entry
+    if not (args.move and fobj.is_dir and get_matcher(args).selects(fobj)):
+        return False
+    source_dir = fobj.dir().replace(DPM, "", 1)
+    return fobj.fname not in move_target_names(move_target(source_dir, args))
+
+def should_descend(fobj, args):
+    # Directories being moved are renamed in one go, so aren't walked
+    return fobj.is_dir and not is_excluded(fobj, args) and not is_moved_whole(fobj, args)
+
+class DeletionPlan():
+    # Everything selected for deletion anywhere in the walk, so that it can be
+    # confirmed once and removed in batches afterwards. Matching directories
+    # are removed whole with gfal-rm -r; what the walk finds inside them only
+    # counts towards the totals.
+    def __init__(self, args):
+        self.args = args
+        self.files = []
+        self.dirs = []
+        self.covered = set()
+        # Covered directories the walk has listed, without -rc there are none
+        self.listed = set()
+        self.affected = set()
+        self.bytes = 0
+        self.covered_files = 0
+
+    def is_covered(self, directory):
+        while True:
+            if directory in self.covered:
+                return True
+            parent = os.path.dirname(directory)
+            # dirname stops at "" for relative paths and at "/" for absolute ones
+            if parent == directory:
+                return False
+            directory = parent
+
+    def fully_listed(self):
+        # Only then do the totals include what is inside the directories
+        return self.covered <= self.listed
+
+    def watch(self, DPMdirectory, files, dir_only=False):
+        # Passes a directory's entries straight through, noting the ones to delete
+        selects = get_matcher(self.args).selects
+        covered = self.is_covered(DPMdirectory)
+        if DPMdirectory in self.covered:
+            self.listed.add(DPMdirectory)
+        for f in files:
+            if covered:
+                if not f.is_dir:
+                    self.covered_files += 1
+                    self.bytes += f.size
+            elif (f.is_dir or not dir_only) and selects(f):
+                if f.is_dir:
+                    self.dirs.append(f)
+                    self.covered.add(os.path.join(DPMdirectory, f.fname))
+                else:
+                    self.files.append(f)
+                    self.bytes += f.size
+                self.affected.add(DPMdirectory)
+            yield f
+
+def entry_depth(f):
+    return f.full_name().count("/")
+
+def delete_batch_from_grid(batch, recursive, batch_no, no_batches, args):
+    urls = [f.full_name(pcol_rm) for f in batch]
+    if recursive:
+        noun = "directory" if len(batch) == 1 else "directories"
+    else:
+        noun = "file" if len(batch) == 1 else "files"
+    print("Deleting {0} {1} [{2}/{3}]".format(len(batch), noun, batch_no+1, no_batches))
+    try:
+        return backend.rm_bulk(urls, args, recursive=recursive)
+    except gfal_backend.GfalError as e:
+        return [e]*len(batch)
+
+def delete_entries(entries, recursive, args):
+    # Returns the number deleted, retrying transient failures like do_bulk_copy
+    batch_size = max(config.delete_batch_size, 1)
+    pending = entries
+    deleted = 0
+    for attempt in range(bulk_retries+1):
+        if attempt > 0:
+            print("> Retrying {0} failed deletion{1}...".format(
+                len(pending), ("" if len(pending) == 1 else "s")))
+            time.sleep(random.uniform(0, min(config.retry_max_delay,
+                                              config.retry_base_delay*2**(attempt-1))))
+        batches = [pending[i:i+batch_size] for i in range(0, len(pending), batch_size)]
+        failed = []
+        results = run_parallel("delete", delete_batch_from_grid,
+                               [(batch, recursive, no, len(batches), args)
+                                for no, batch in enumerate(batches)],
+                               args, weights=[len(i) for i in batches])
+        for batch, errors in zip(batches, results):
+            for f, error in zip(batch, errors):
+                if error is None:
+                    deleted += 1
+                elif gfal_backend.classify(error) == "permanent":
+                    error_print(error.message)
+                    backend.record_failure("rm", f.full_name(pcol_rm), error)
+                else:
+                    failed.append((f, error))
+        pending = [f for f, error in failed]
+        if len(pending) == 0:
+            break
+    for f, error in failed:
+        error_print(error.message)
+        backend.record_failure("rm", f.full_name(pcol_rm), error, bulk_retries+1)
+    return deleted
+
+def do_planned_delete(plan, args):
+    no_files, no_dirs = len(plan.files), len(plan.dirs)
+    if no_files+no_dirs == 0:
+        print(_wrap_str("> Nothing to delete", 32))
+        return
+    what = []
+    if no_files > 0:
+        what.append("{0} file{1}".format(no_files, ("" if no_files == 1 else "s")))
+    fully_listed = plan.fully_listed()
+    if no_dirs > 0 and fully_listed:
+        what.append("{0} director{1} holding {2} file{3}".format(
+            no_dirs, ("y" if no_dirs == 1 else "ies"),
+            plan.covered_files, ("" if plan.covered_files == 1 else "s")))
+    elif no_dirs > 0:
+        # Not listed inside, so there are no counts to give
+        what.append("{0} director{1} with everything in {2}".format(
+            no_dirs, ("y" if no_dirs == 1 else "ies"), ("it" if no_dirs == 1 else "them")))
+    if fully_listed:
+        total = ", {0} in total,".format(format_size(plan.bytes))
+    else:
+        total = ","
+    print(_wrap_str("> Deleting {0}{1} from {2} director{3}".format(
+        " and ".join(what), total, len(plan.affected),
+        ("y" if len(plan.affected) == 1 else "ies")), 32))
+    query_str = "Do you really want to delete {0} [y/n]?\n".format(" and ".join(what))
+    if not get_yes_no(input(query_str)):
+        return
+
+    # Deepest first, so nothing is removed before what is below it
+    deleted = 0
+    levels = sorted(set(entry_depth(f) for f in plan.files+plan.dirs), reverse=True)
+    for level in levels:
+        files = [f for f in plan.files if entry_depth(f) == level]
+        dirs = [f for f in plan.dirs if entry_depth(f) == level]
+        if len(files) > 0:
+            deleted += delete_entries(files, False, args)
+        if len(dirs) > 0:
+            deleted += delete_entries(dirs, True, args)
+    for directory in plan.affected:
+        forget_listing(directory)
+    print("> Deleted {0} of {1}".format(deleted, no_files+no_dirs))
 
 def get_yes_no(string):
     if string.lower().startswith("y"):
         return True
     return False
 
-def get_unique_runcards(files):
-    remove_digits = str.maketrans('', '', string.digits)
-    return list(set(f.fname.translate(remove_digits).replace("-.", "-SEED.")
-                    for f in files if not f.is_dir))
+class RuncardGroup():
+    __slots__ = ("files", "size", "seeds")
+
+    def __init__(self):
+        self.files = 0
+        self.size = 0
+        self.seeds = array.array("q")
+
+def format_ranges(numbers, separator=", ", limit=8):
+    # [1, 2, 3, 7, 9, 10] -> "1-3, 7, 9-10", only the first `limit` ranges
+    # unless limit is None
+    ranges = []
+    for number in numbers:
+        if len(ranges) > 0 and ranges[-1][1] == number-1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    if limit is None:
+        limit = len(ranges)
+    text = separator.join(str(a) if a == b else "{0}-{1}".format(a, b) for a, b in ranges[:limit])
+    if len(ranges) > limit:
+        text += separator+"..."
+    return text
+
+class RuncardIndex():
+    # Groups files named <runcard><seed>.<ext> by runcard in one pass. The
+    # seed is the last number before the extension, so digits elsewhere in the
+    # name stay part of the runcard.
+    pattern = re.compile(r"\A(.*\D)?(\d+)(\.[^.]*)?\Z")
+
+    def __init__(self):
+        self.groups = {}
+
+    def add(self, fobj):
+        match = self.pattern.match(fobj.fname)
+        if match is None:
+            name, seed = fobj.fname, None
+        else:
+            name = "{0}SEED{1}".format(match.group(1) or "", match.group(3) or "")
+            seed = int(match.group(2))
+        group = self.groups.get(name)
+        if group is None:
+            group = self.groups[name] = RuncardGroup()
+        group.files += 1
+        group.size += fobj.size
+        if seed is not None:
+            group.seeds.append(seed)
+
+    def lines(self):
+        for name in sorted(self.groups):
+            group = self.groups[name]
+            if len(group.seeds) == 0:
+                yield "{0:40} {1:>7} file{2:1} {3:>38} {4:>9}".format(
+                    name, group.files, ("" if group.files == 1 else "s"), "",
+                    format_size(group.size))
+                continue
+            seeds = sorted(set(group.seeds))
+            missing = seeds[-1]-seeds[0]+1-len(seeds)
+            line = "{0:40} {1:>7} seed{2:1} {3:>15} {4:>22} {5:>9}".format(
+                name, len(seeds), ("" if len(seeds) == 1 else "s"),
+                "{0}-{1}".format(seeds[0], seeds[-1]),
+                "{0} missing".format(missing) if missing > 0 else "none missing",
+                format_size(group.size))
+            if missing > 0:
+                line += "  missing: "+format_ranges(self._missing(seeds))
+            yield line
+
+    def _missing(self, seeds):
+        for a, b in zip(seeds, seeds[1:]):
+            for seed in range(a+1, b):
+                yield seed
+
+    def report(self):
+        for line in self.lines():
+            print(line)
+        no_files = sum(i.files for i in self.groups.values())
+        total_size = sum(i.size for i in self.groups.values())
+        print(_wrap_str("> {0} unique runcards, {1} files, {2}".format(
+            len(self.groups), no_files, format_size(total_size)), 34))
+
+def gfal_ls_obj_iter(folder):
+    url = "{0}{1}".format(DPM.replace(pcol_def, pcol_ls, 1), folder)
+    lines = None
+    if dir_cache is not None and not refresh_listings:
+        lines = dir_cache.get(dpm_user, pcol_ls, folder)
+    if lines is None:
+        lines = backend.ls_iter(url)
+    directory = url.replace(pcol_ls, pcol_def, 1)
+    try:
+        for x in lines:
+            yield DPMFile(x.replace(pcol_ls, pcol_def, 1), directory)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
 
 def gfal_ls_obj_wrapper(*args):
     if len(args) == 0:
         args = [""]
     ret_files = []
     for folder in args:
-        cmd_args = ["{0}{1}".format(DPM.replace(pcol_def, pcol_ls, 1), folder)]
-        cmd_args += ["-l", "-H"]
-        files = bash_call("gfal-ls", *cmd_args)
+        url = "{0}{1}".format(DPM.replace(pcol_def, pcol_ls, 1), folder)
+        files = None
+        if dir_cache is not None and not refresh_listings:
+            files = dir_cache.get(dpm_user, pcol_ls, folder)
+        if files is None:
+            try:
+                files = backend.ls(url)
+            except gfal_backend.GfalError as e:
+                error_print(e.message)
+                files = []
+            else:
+                if dir_cache is not None:
+                    dir_cache.put(dpm_user, pcol_ls, folder, files)
         ret_files += [
-            DPMFile( x.replace(pcol_ls, pcol_def, 1), cmd_args[0].replace(pcol_ls, pcol_def, 1))
+            DPMFile( x.replace(pcol_ls, pcol_def, 1), url.replace(pcol_ls, pcol_def, 1))
             for x in files ]
     return ret_files
 
+def forget_listing(directory):
+    if dir_cache is not None:
+        dir_cache.invalidate(dpm_user, directory)
+
 def print_files(files, args):
     if not args.summary:
         print("\n".join(i.return_line_as_str(args) for i in files))
 
+def bare_line(fileobj, args, dir):
+    # TODO make this more elegant
+    ret = fileobj.return_line_as_str(args).split()
+    return " ".join(ret[:-1]+[os.path.join(dir, ret[-1])])
+
 def print_bare_files(files, args, dir):
     if args.summary:
         return
-    # TODO make this more elegant
-    printstr = []
-    for i in files:
-        if not i.is_dir:
-            ret = i.return_line_as_str(args).split()
-            printstr.append(" ".join(ret[:-1]+[os.path.join(dir, ret[-1])]))
-    print("\n".join(printstr))
+    print("\n".join(bare_line(i, args, dir) for i in files if not i.is_dir))
+
+def write_records(files):
+    for f in files:
+        record_writer.add(f.record())
+    record_writer.flush()
+
+# Typed keys for --sortkey and --top. "time" used to compare the "HH:MM"
+# strings and "fname" the attribute, both kept as aliases
+sort_keys = {"name": lambda f: f.fname,
+             "size": lambda f: f.size,
+             "mtime": lambda f: f.mtime}
+sort_aliases = {"time": "mtime", "fname": "name"}
+
+def get_sort_key(args, default="name"):
+    sortkey = args.sortkey if args.sortkey is not None else default
+    return sort_keys[sort_aliases.get(sortkey, sortkey)]
 
 def sort_files(files, args):
     if not args.sort:
         return files
     else:
-        if args.sortkey is not None:
-            sortattr = args.sortkey
-        else:
-            sortattr = "fname"
-        files.sort(key=lambda f : getattr(f,sortattr), reverse = args.reverse)
+        files.sort(key=get_sort_key(args), reverse = args.reverse)
         return files
 
+class Descending():
+    # Turns the heap around for --top --reverse, names can't just be negated
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return self.value < other.value
+
+class TopEntries():
+    # The n entries with the largest key (smallest with --reverse) in a heap
+    # of at most n, so a whole tree can be searched in O(entries*log(n))
+    # without keeping its listing
+    def __init__(self, n, args):
+        self.n = max(n, 0)
+        self.args = args
+        self.key = get_sort_key(args, "size")
+        self.smallest = args.reverse
+        self.heap = []
+        self.seen = 0
+
+    def add(self, fobj, directory):
+        self.seen += 1
+        key = self.key(fobj)
+        if self.smallest:
+            key = Descending(key)
+        # Earlier entries win ties
+        entry = (key, -self.seen, directory, fobj)
+        if len(self.heap) < self.n:
+            heapq.heappush(self.heap, entry)
+        elif self.n > 0 and entry > self.heap[0]:
+            heapq.heapreplace(self.heap, entry)
+
+    def report(self):
+        args = self.args
+        if record_writer is not None:
+            write_records(i[3] for i in sorted(self.heap, reverse=True))
+            return
+        for key, _, directory, f in sorted(self.heap, reverse=True):
+            if args.bare:
+                print(bare_line(f, args, directory))
+            elif not args.summary:
+                print("{0:>9} {1} {2:>2} {3:>5}  {4}".format(
+                    format_size(f.size), f.month, f.day, f.time, os.path.join(directory, f.fname)))
+        if not args.bare:
+            print(_wrap_str("> Top {0} of {1} matching {2}".format(
+                len(self.heap), self.seen, ("directories" if args.dir else "files")), 32))
+
+def format_size(size):
+    for suffix, factor in sorted(size_suffixes.items(), key=lambda i: -i[1]):
+        if size >= factor:
+            return "{0:.1f}{1}".format(size/float(factor), suffix)
+    return "{0}B".format(size)
+
+def do_du(DPMdirectory, args):
+    root = DPMdirectory.rstrip("/")
+    totals = {}
+    order = []
+    for directory, files in walk_directories(root, args, recursive=True):
+        size, no_files = 0, 0
+        for f in select_files(files, args, False):
+            if not f.is_dir:
+                size += f.size
+                no_files += 1
+        totals[directory] = [size, no_files]
+        order.append(directory)
+    # The walk is depth-first pre-order, so going backwards every directory
+    # is complete before it is added to its parent
+    for directory in reversed(order[1:]):
+        parent = totals[os.path.dirname(directory)]
+        parent[0] += totals[directory][0]
+        parent[1] += totals[directory][1]
+
+    def depth(directory):
+        relative = directory[len(root):].strip("/")
+        return 0 if relative == "" else relative.count("/")+1
+
+    total_size, total_files = totals[root]
+    shown = [i for i in order[1:] if depth(i) <= args.du_depth]
+    shown.sort(key=lambda i: totals[i][0], reverse=True)
+    for directory in shown:
+        size, no_files = totals[directory]
+        share = 100.0*size/total_size if total_size > 0 else 0.0
+        print("{0:>9} {1:>10} {2:5.1f}%  {3}".format(format_size(size), no_files,
+                                                     share, directory))
+    print(_wrap_str("> {0} in {1} matching files under {2}".format(
+        format_size(total_size), total_files, DPMdirectory if DPMdirectory != "" else "."), 32))
+
 def make_directory(args):
     for directory in args.directories:
         create_dir(directory, args)
+        forget_listing(directory)
+
+def stream_directories(DPMdirectory, args, recursive=False, max_depth=None):
+    # Each directory's entries are handed out as a generator straight from
+    # gfal-ls, so the walk is sequential: subdirectories are only known once
+    # the consumer has run through the parent's entries.
+    pending = [(DPMdirectory, 0)]
+    while pending:
+        directory, depth = pending.pop()
+        subdirs = []
+        descend = recursive and (max_depth is None or depth < max_depth)
+
+        def entries(directory=directory, subdirs=subdirs):
+            for f in gfal_ls_obj_iter(directory):
+                if descend and should_descend(f, args):
+                    subdirs.append((os.path.join(directory, f.fname), depth+1))
+                yield f
+
+        yield directory, entries()
+        pending.extend(reversed(subdirs))
+
+def get_listing_pool(no_listers):
+    # Kept for the whole run, or for as long as the agent is up
+    global listing_pool
+    if listing_pool is not None and listing_pool._processes != no_listers:
+        listing_pool.terminate()
+        listing_pool = None
+    if listing_pool is None:
+        listing_pool = mp.pool.ThreadPool(processes=no_listers)
+    return listing_pool
+
+def walk_directories(DPMdirectory, args, recursive=False, max_depth=None):
+    if not recursive:
+        yield DPMdirectory, gfal_ls_obj_wrapper(DPMdirectory)
+        return
+    # Keep up to no_listers directories in flight, but hand them back in
+    # depth-first pre-order so the output doesn't depend on timing.
+    no_listers = max(args.list_threads, 1)
+    pool = get_listing_pool(no_listers)
+    pending = collections.deque([[DPMdirectory, 0, None]])
+    while pending:
+        for entry in itertools.islice(pending, no_listers):
+            if entry[2] is None:
+                entry[2] = pool.apply_async(gfal_ls_obj_wrapper, (entry[0],))
+        directory, depth, result = pending.popleft()
+        files = result.get()
+        if max_depth is None or depth < max_depth:
+            subdirs = [[os.path.join(directory, f.fname), depth+1, None]
+                       for f in files if should_descend(f, args)]
+            pending.extendleft(reversed(subdirs))
+        yield directory, files
 
 def parse_directory(DPMdirectory, recursive=False, bare=False, exclude_dirs=None, dir_only=False):
-    files = gfal_ls_obj_wrapper(DPMdirectory)
+    if top_entries is not None:
+        # Nothing is printed until the whole search has been seen
+        for directory, files in walk_directories(DPMdirectory, args, recursive=recursive,
+                                                 max_depth=args.max_depth):
+            for f in select_files(files, args, dir_only):
+                if f.is_dir == dir_only:
+                    top_entries.add(f, directory)
+        return
+    if args.stream and not args.sort:
+        for directory, files in stream_directories(DPMdirectory, args, recursive=recursive,
+                                                   max_depth=args.max_depth):
+            stream_directory(directory, files, bare=bare, dir_only=dir_only)
+        return
+    for directory, files in walk_directories(DPMdirectory, args, recursive=recursive,
+                                             max_depth=args.max_depth):
+        process_directory(directory, files, bare=bare, dir_only=dir_only)
+
+def stream_directory(DPMdirectory, files, bare=False, dir_only=False):
+    no_files, no_dirs = 0, 0
+    # Only hold on to entries when something has to be done with them after
+    # the listing has finished
+    keep = args.copy or args.move
+    selected = []
+    if deletion_plan is not None:
+        files = deletion_plan.watch(DPMdirectory, files, dir_only)
+    if record_writer is not None:
+        write_records(select_files(files, args, dir_only))
+        return
+    for f in select_files(files, args, dir_only):
+        if f.is_dir:
+            no_dirs += 1
+        else:
+            no_files += 1
+        if keep:
+            selected.append(f)
+        if runcard_index is not None and not bare:
+            if not f.is_dir:
+                runcard_index.add(f)
+            continue
+        if args.summary:
+            continue
+        if bare:
+            if not f.is_dir:
+                print(bare_line(f, args, DPMdirectory))
+        else:
+            print(f.return_line_as_str(args))
 
-    if recursive:
-        for f in files:
-            if f.is_dir:
-                if not is_excluded(f, args):
-                    parse_directory(os.path.join(DPMdirectory, f.fname), recursive=recursive,
-                                    bare=bare, exclude_dirs=exclude_dirs, dir_only=dir_only)
+    if no_files+no_dirs == 0:
+        return
+    if not bare:
+        if no_files >0:
+            print(_wrap_str("> {0} matching files found in {1}.".format(no_files,
+                                                                        DPMdirectory), 32))
+        if no_dirs>0:
+            print(_wrap_str("> {0} matching directories found in {1}.".format(no_dirs,
+                                                                              DPMdirectory), 32))
 
-    files = sort_files(files, args)
-    if args.search is not None:
-        files = do_search(files, args)
-    if args.reject is not None:
-        files = do_reject(files, args)
-    if dir_only:
-        files = [i for i in files if i.is_dir]
+    if args.copy:
+        do_copy(DPMdirectory, args, selected)
+    if args.move:
+        do_move(DPMdirectory, args, selected)
 
+def process_directory(DPMdirectory, files, bare=False, dir_only=False):
+    if deletion_plan is not None:
+        files = list(deletion_plan.watch(DPMdirectory, files, dir_only))
+    files = sort_files(files, args)
+    files = list(select_files(files, args, dir_only))
+    if record_writer is not None:
+        # Nothing but the records, so the output can be parsed
+        write_records(files)
+        return
 
     no_files = len([f for f in files if not f.is_dir])
     no_dirs = len([f for f in files if f.is_dir])
@@ -361,12 +1392,12 @@ def parse_directory(DPMdirectory, recursive=False, bare=False, exclude_dirs=None
     if something_found:
         if bare:
             print_bare_files(files, args, DPMdirectory)
-        elif not args.unique_runcards:
+        elif runcard_index is None:
             print_files(files, args)
         else:
-            unique_runcards = get_unique_runcards(files)
-            print("\n".join(i for i in unique_runcards))
-            print(_wrap_str("> {0} unique runcards".format(len(unique_runcards)), 34))
+            for f in files:
+                if not f.is_dir:
+                    runcard_index.add(f)
         if no_files+no_dirs > file_count_reprint_no and not bare:
             if no_files >0:
                 print(_wrap_str("> {0} files matched".format(no_files), 32))
@@ -379,8 +1410,41 @@ def parse_directory(DPMdirectory, recursive=False, bare=False, exclude_dirs=None
         do_copy(DPMdirectory, args, files)
     if args.move:
         do_move(DPMdirectory, args, files)
-    if args.delete:
-        do_delete(DPMdirectory, files, args)
+
+def expand_upload_list(paths, griddir):
+    # Directories are uploaded with their structure, like cp -r: dir/a/b.dat
+    # ends up in griddir/dir/a/b.dat
+    uploads = []
+    remote_dirs = []
+    for path in paths:
+        if not os.path.exists(path):
+            error_print("{0} does not exist, skipping it.".format(path))
+            continue
+        if not os.path.isdir(path):
+            uploads.append((path, griddir))
+            continue
+        top = os.path.basename(os.path.normpath(path))
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            reldir = os.path.relpath(root, path)
+            remote_dir = os.path.normpath(os.path.join(griddir, top, reldir))
+            remote_dirs.append(remote_dir)
+            for fname in sorted(files):
+                if fname == transfer_journal.journal_name:
+                    continue
+                uploads.append((os.path.join(root, fname), remote_dir))
+    return uploads, remote_dirs
+
+def leaf_directories(directories):
+    # mkdir -p on the deepest directories creates everything above them too
+    directories = set(os.path.normpath(i) for i in directories)
+    parents = set()
+    for directory in directories:
+        parent = os.path.dirname(directory)
+        while parent not in ("", "/") and parent not in parents:
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+    return sorted(directories-parents)
 
 def do_copy_to_grid(args):
     if args.output_directory is not None:
@@ -388,50 +1452,386 @@ def do_copy_to_grid(args):
     else:
         error_print("Please specify an output directory with -o.")
         return
-    no_files = len(args.copy_to_grid)
-    for file_no, xfile in enumerate(args.copy_to_grid):
-        copy_file_to_grid(xfile, output, file_no, no_files, args)
+    uploads, remote_dirs = expand_upload_list(args.copy_to_grid, output)
+    no_files = len(uploads)
+    print("> Copying {0} file{1} to the grid...".format(no_files,
+                                                        ("" if no_files == 1 else "s")))
+    new_dirs = leaf_directories(remote_dirs)
+    run_parallel("mkdir", create_dir, [(i, args) for i in new_dirs], args)
+    run_parallel("copy", copy_file_to_grid,
+                 [(xfile, griddir, file_no, no_files, args)
+                  for file_no, (xfile, griddir) in enumerate(uploads)],
+                 args, weights=[os.path.getsize(i[0]) for i in uploads])
+    forget_listing(output)
+
+LocalFile = collections.namedtuple("LocalFile", ["fname", "path", "size", "mtime"])
+
+def _relative_to(root, path):
+    root = root.strip("/")
+    path = path.strip("/")
+    if root == "":
+        return path
+    return path[len(root):].lstrip("/")
+
+def list_remote_tree(DPMdirectory, args):
+    remote = {}
+    for directory, files in walk_directories(DPMdirectory, args, recursive=args.recursive,
+                                             max_depth=args.max_depth):
+        for f in select_files(files, args):
+            if not f.is_dir:
+                remote[_relative_to(DPMdirectory, os.path.join(directory, f.fname))] = f
+    return remote
+
+def remote_dir_exists(DPMdirectory):
+    url = "{0}{1}".format(DPM.replace(pcol_def, pcol_ls, 1), DPMdirectory)
+    try:
+        return backend.ls(url, missing_ok=True) is not None
+    except gfal_backend.GfalError:
+        # Anything else is reported when the directory is listed
+        return True
 
-if __name__ == "__main__":
-    args = lscp_args.get_args()
+def list_local_tree(localdir, args):
+    local = {}
+    selects = get_matcher(args).selects
+    for root, dirs, files in os.walk(localdir):
+        reldir = os.path.relpath(root, localdir)
+        if reldir == ".":
+            reldir = ""
+        elif args.max_depth is not None and reldir.count(os.sep)+1 > args.max_depth:
+            dirs[:] = []
+            continue
+        dirs[:] = sorted(d for d in dirs if not is_excluded(LocalFile(d, None, 0, 0), args))
+        if not args.recursive:
+            dirs[:] = []
+        for fname in sorted(files):
+            if fname == transfer_journal.journal_name:
+                continue
+            path = os.path.join(root, fname)
+            st = os.stat(path)
+            lfile = LocalFile(fname, path, st.st_size, st.st_mtime)
+            if selects(lfile):
+                local[os.path.join(reldir, fname)] = lfile
+    return local
+
+def _mtime_slack(remote_file):
+    # ls -l only gives minutes for recent files and days for older ones
+    return 60 if ":" in remote_file.time else 24*3600
+
+def sync_confirmed(extraneous, where):
+    no_files = len(extraneous)
+    query_str = "Do you really want to delete {1} {0} file{2} not present {3} [y/n]?\n".format(
+        no_files,
+        ("this" if no_files == 1 else "these"),
+        ("" if no_files == 1 else "s"),
+        where)
+    return get_yes_no(input(query_str))
+
+def do_sync(args):
+    DPMdirectory = args.directories[0] if len(args.directories) > 0 else ""
+    localdir = get_outdir(args)
+    # Anything sync decides to transfer is meant to replace what is there
+    sync_args = copy.copy(args)
+    sync_args.force = True
+    sync_args.parent = True
+
+    if args.sync == "up" and not remote_dir_exists(DPMdirectory):
+        # The first upload into a new directory
+        remote = {}
+    else:
+        remote = list_remote_tree(DPMdirectory, args)
+    local = list_local_tree(localdir, args)
+
+    if args.sync == "down":
+        changed = sorted(rel for rel, f in remote.items()
+                         if rel not in local or local[rel].size != f.size
+                         or f.mtime > local[rel].mtime+_mtime_slack(f))
+        extraneous = sorted(rel for rel in local if rel not in remote)
+    else:
+        changed = sorted(rel for rel, f in local.items()
+                         if rel not in remote or remote[rel].size != f.size
+                         or f.mtime > remote[rel].mtime+_mtime_slack(remote[rel]))
+        extraneous = sorted(rel for rel in remote if rel not in local)
+
+    no_files = len(changed)
+    no_total = len(remote) if args.sync == "down" else len(local)
+    print("> {0} of {1} file{2} to sync {3}".format(
+        no_files, no_total, ("" if no_total == 1 else "s"), args.sync))
+
+    if no_files > 0:
+        if args.sync == "down":
+            for rel in changed:
+                reldir = os.path.dirname(rel)
+                if not os.path.isdir(os.path.join(localdir, reldir)):
+                    os.makedirs(os.path.join(localdir, reldir))
+            run_parallel("copy", copy_to_dir,
+                         [(remote[rel], sync_args, file_no, no_files,
+                           os.path.join(localdir, os.path.dirname(rel)))
+                          for file_no, rel in enumerate(changed)],
+                         args, weights=[remote[rel].size for rel in changed])
+        else:
+            run_parallel("copy", copy_file_to_grid,
+                         [(local[rel].path, os.path.join(DPMdirectory, os.path.dirname(rel)),
+                           file_no, no_files, sync_args)
+                          for file_no, rel in enumerate(changed)],
+                         args, weights=[local[rel].size for rel in changed])
+            forget_listing(DPMdirectory)
+
+    if args.delete_extraneous and len(extraneous) > 0:
+        if args.sync == "down":
+            if sync_confirmed(extraneous, "on the grid"):
+                for rel in extraneous:
+                    print("Deleting {0}".format(local[rel].path))
+                    os.remove(local[rel].path)
+        elif sync_confirmed(extraneous, "locally"):
+            no_extraneous = len(extraneous)
+            run_parallel("delete", delete_file_from_grid,
+                         [(remote[rel], file_no, no_extraneous, args)
+                          for file_no, rel in enumerate(extraneous)], args)
+            forget_listing(DPMdirectory)
+
+def report_metrics(args):
+    if metrics is None:
+        return
+    if args.metrics:
+        print(metrics.format_summary())
+    if args.metrics_out is not None:
+        metrics.write_json(args.metrics_out)
+
+def report_failures(args):
+    failures = backend.failures
+    if len(failures) == 0:
+        return 0
+    error_print("{0} operation{1} failed permanently:".format(
+        len(failures), ("" if len(failures) == 1 else "s")))
+    for failure in failures:
+        error_print("  {0:8} {1} [{2}, code {3}, {4} attempt{5}]".format(
+            failure["operation"], failure["url"], failure["kind"], failure["code"],
+            failure["attempts"], ("" if failure["attempts"] == 1 else "s")))
+    if args.failures_out is not None:
+        with open(args.failures_out, "w") as outfile:
+            json.dump(failures, outfile, indent=2)
+    return 1
+
+def reset_run_state():
+    # Everything one run sets up or collects, so the agent starts each
+    # request from scratch
+    global pcol_ls, pcol_rm, pcol_down, pcol_up, pcol_mv, pcol_mkdir, DPM, dpm_user
+    global dir_cache, refresh_listings, matcher, metrics, deletion_plan, verifier
+    global runcard_index, top_entries, record_writer, journals, move_targets
+    pcol_ls = config.protocol_list
+    pcol_rm = config.protocol_delete
+    pcol_down = config.protocol_download
+    pcol_up = config.protocol_upload
+    pcol_mv = config.protocol_move
+    pcol_mkdir = config.protocol_mkdir
+    DPM = pcol_def+config.DPM
+    dpm_user = default_user
+    dir_cache = None
+    refresh_listings = False
+    matcher = None
+    metrics = None
+    deletion_plan = None
+    verifier = None
+    runcard_index = None
+    top_entries = None
+    record_writer = None
+    journals = {}
+    move_targets = {}
+    queued_jobs.clear()
+    del stale_listings[:]
+    created_dirs.clear()
+
+def get_warm_backend(name, debug):
+    if (name, debug) not in warm_backends:
+        warm_backends[(name, debug)] = gfal_backend.get_backend(name, run_command, stream_command,
+                                                                debug=debug)
+    return warm_backends[(name, debug)]
+
+def get_warm_cache():
+    global warm_cache
+    if warm_cache is None:
+        warm_cache = listing_cache.ListingCache(config.cache_file, config.cache_ttl)
+    return warm_cache
+
+def is_read_only(args):
+    return not (args.copy or args.move or args.delete or args.mkdir or args.sync is not None
+                or args.copy_to_grid is not None or args.agent is not None)
+
+def agent_request(argv, cwd, stdout, stderr):
+    # Runs one forwarded request with its output going back to the client
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        os.chdir(cwd)
+        return main(argv, read_only=True)
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+
+def agent_command(args):
+    global agent_mode
+    if args.agent == "run":
+        agent_mode = True
+        # Warm up the default backend and the listing cache straight away
+        get_warm_backend(config.backend, False)
+        get_warm_cache()
+        return agent.serve(agent_request)
+    if args.agent == "start":
+        if agent.send_command("status") is not None:
+            print("Agent already running")
+            return 0
+        log_file = os.path.join(os.path.dirname(config.agent_socket), "agent.log")
+        if not os.path.isdir(os.path.dirname(log_file)):
+            os.makedirs(os.path.dirname(log_file))
+        with open(log_file, "a") as log:
+            child = sp.Popen([sys.executable, os.path.abspath(__file__), "--agent", "run"],
+                             stdin=sp.DEVNULL, stdout=log, stderr=sp.STDOUT,
+                             start_new_session=True)
+        for i in range(50):
+            if agent.send_command("status") is not None:
+                print("Agent started, pid {0}".format(child.pid))
+                return 0
+            if child.poll() is not None:
+                break
+            time.sleep(0.1)
+        error_print("Agent failed to start, see {0}".format(log_file))
+        return 1
+    reply = agent.send_command(args.agent)
+    if reply is None:
+        print("No agent running")
+        return 1 if args.agent == "status" else 0
+    if args.agent == "stop":
+        print("Agent stopped")
+    else:
+        print(reply, end="")
+    return 0
+
+def main(argv=None, read_only=False):
+    # Returns the exit code. With read_only (in the agent) requests that
+    # change anything are refused with None, for the client to run itself
+    global args, debug, pcol_ls, pcol_rm, pcol_down, pcol_up, pcol_mv, pcol_mkdir
+    global metrics, backend, dpm_user, DPM, dir_cache, refresh_listings
+    global deletion_plan, verifier, runcard_index, top_entries, record_writer
+    reset_run_state()
+    args = lscp_args.get_args(argv)
+    if read_only and not is_read_only(args):
+        return None
     debug = args.debug
 
+    if args.agent is not None:
+        return agent_command(args)
+
     if args.protocol is not None:
         pcol_ls   = args.protocol
         pcol_rm   = args.protocol
         pcol_down = args.protocol
         pcol_up   = args.protocol
         pcol_mv   = args.protocol
+        pcol_mkdir = args.protocol
+
+    if args.metrics or args.metrics_out is not None:
+        metrics = transfer_metrics.Metrics()
+
+    try:
+        backend = get_warm_backend(args.backend, args.debug)
+        backend = gfal_backend.RetryingBackend(backend, args.retries, config.retry_base_delay,
+                                               config.retry_max_delay, config.retry_budget,
+                                               warn=warning_print, metrics=metrics,
+                                               on_transient=back_off_current)
+    except gfal_backend.GfalError as e:
+        error_print(e.message)
+        return -1
 
     if args.user:
-        DPM = DPM.format(args.user)
-    else:
-        DPM = DPM.format(default_user)
+        dpm_user = args.user
+    DPM = DPM.format(dpm_user)
+
+    if not args.no_cache:
+        dir_cache = get_warm_cache()
+        refresh_listings = args.refresh
 
     if args.time:
         start_time = datetime.datetime.now()
 
+    if args.delete:
+        deletion_plan = DeletionPlan(args)
+    if args.verify:
+        verifier = Verifier(args)
+    if args.unique_runcards and not args.bare and args.format == "text":
+        runcard_index = RuncardIndex()
+    if args.top is not None and not (args.copy or args.move or args.delete):
+        top_entries = TopEntries(args.top, args)
+    if args.format != "text" and not (args.copy or args.move or args.delete):
+        record_writer = listing_output.RecordWriter(args.format)
+
     if args.mkdir:
         make_directory(args)
-        sys.exit(0)
+        report_metrics(args)
+        return report_failures(args)
 
-    if args.copy_to_grid is not None:
-        do_copy_to_grid(args)
+    try:
+        if args.sync is not None:
+            do_sync(args)
 
-    elif args.directories == []:
-        parse_directory("", recursive = args.recursive, bare=args.bare,
-                        exclude_dirs = args.exclude, dir_only=args.dir)
-    else:
-        if not args.move:
-            for DPMdirectory in args.directories:
-                parse_directory(DPMdirectory, recursive = args.recursive,
-                                bare=args.bare, exclude_dirs=args.exclude,
-                                dir_only=args.dir)
+        elif args.copy_to_grid is not None:
+            do_copy_to_grid(args)
+
+        elif args.du:
+            for DPMdirectory in (args.directories if args.directories != [] else [""]):
+                do_du(DPMdirectory, args)
+
+        elif args.directories == []:
+            parse_directory("", recursive = args.recursive, bare=args.bare,
+                            exclude_dirs = args.exclude, dir_only=args.dir)
         else:
-            for DPMdirectory in args.directories[:1]:
-                parse_directory(DPMdirectory, bare=args.bare, dir_only=args.dir)
+            if not args.move:
+                for DPMdirectory in args.directories:
+                    parse_directory(DPMdirectory, recursive = args.recursive,
+                                    bare=args.bare, exclude_dirs=args.exclude,
+                                    dir_only=args.dir)
+            elif args.recursive and len(args.directories) == 2 and \
+                 is_inside(args.directories[1], args.directories[0]):
+                error_print("Cannot move {0} recursively into itself".format(args.directories[0]))
+            else:
+                parse_directory(args.directories[0], recursive=args.recursive,
+                                bare=args.bare, exclude_dirs=args.exclude, dir_only=args.dir)
+
+        if runcard_index is not None:
+            runcard_index.report()
+        if top_entries is not None:
+            top_entries.report()
+
+        if deletion_plan is not None:
+            do_planned_delete(deletion_plan, args)
+
+        # Transfers queued while walking may still be running
+        wait_for_queued_jobs()
+        shutdown_executors()
+    except KeyboardInterrupt:
+        error_print("Interrupted, abandoning queued jobs")
+        return 130
+    except BrokenPipeError:
+        # Whatever the output was piped into stopped reading, e.g. head.
+        # Point stdout somewhere harmless so the final flush doesn't fail too
+        if not agent_mode:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        # Only left with work here after an exception or ^C
+        shutdown_executors(abort=True)
 
     if args.time:
         end_time = datetime.datetime.now()
         total_time = (end_time-start_time).__str__().split(".")[0]
         print("> Time taken {0}".format(total_time))
+
+    report_metrics(args)
+    return report_failures(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,78 @@
+from __future__ import print_function
+import os
+import sqlite3
+import threading
+import time
+
+schema_version = 2
+
+def _normpath(path):
+    path = path.strip("/")
+    if path == "":
+        return ""
+    return os.path.normpath(path)
+
+def _ancestors(path):
+    ancestors = [""]
+    parts = path.split("/") if path != "" else []
+    for i in range(1, len(parts)+1):
+        ancestors.append("/".join(parts[:i]))
+    return ancestors
+
+class ListingCache():
+    def __init__(self, cache_file, ttl):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir != "" and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Listing threads share the connection, so access is serialised with
+        # self.lock rather than sqlite's own thread check.
+        self.conn = sqlite3.connect(cache_file, timeout=30,
+                                    check_same_thread=False)
+        with self.lock, self.conn:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            if version != schema_version:
+                self.conn.execute("DROP TABLE IF EXISTS listings")
+                self.conn.execute("PRAGMA user_version = {0}".format(schema_version))
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS listings (
+                                     user TEXT, protocol TEXT, path TEXT,
+                                     fetched REAL, listing TEXT,
+                                     PRIMARY KEY (user, protocol, path))""")
+
+    def get(self, user, protocol, path):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT fetched, listing FROM listings WHERE user=? AND protocol=? AND path=?",
+                (user, protocol, _normpath(path))).fetchone()
+        if row is None or time.time()-row[0] > self.ttl:
+            return None
+        return [i for i in row[1].split("\n") if i != ""]
+
+    def put(self, user, protocol, path, lines):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?, ?)",
+                (user, protocol, _normpath(path), time.time(), "\n".join(lines)))
+
+    def invalidate(self, user, path):
+        # A change to path affects the listing of every directory above it
+        # (mkdir -p may have created any of them) and everything below it.
+        path = _normpath(path)
+        ancestors = _ancestors(path)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM listings WHERE user=? AND path=?",
+                [(user, i) for i in ancestors])
+            if path != "":
+                prefix = path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                self.conn.execute(
+                    "DELETE FROM listings WHERE user=? AND path LIKE ? ESCAPE '\\'",
+                    (user, prefix+"/%"))
+            else:
+                self.conn.execute("DELETE FROM listings WHERE user=?", (user,))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
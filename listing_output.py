@@ -0,0 +1,52 @@
+from __future__ import print_function
+import csv
+import json
+import sys
+
+formats = ["text", "jsonl", "csv", "null"]
+fields = ["url", "name", "size", "mtime", "permissions", "is_dir"]
+# Filled in directly rather than building a dict per entry for json.dumps
+jsonl_template = ('{{"url":{0},"name":{1},"size":{2},"mtime":{3},"permissions":{4},'
+                  '"is_dir":{5}}}\n')
+
+class RecordWriter():
+    # Machine readable listings: one record per entry with none of the
+    # colour or padding of the normal output. Records are collected and
+    # written batch_size at a time, so a listing of millions of entries costs
+    # a few large writes rather than a print per entry.
+    #
+    #   jsonl  one JSON object per line
+    #   csv    header line, then one row per entry, is_dir as 1 or 0
+    #   null   just the URLs, each ended by a NUL byte (for xargs -0)
+    def __init__(self, fmt, batch_size=10000):
+        self.format = fmt
+        self.batch_size = batch_size
+        self.records = []
+        self.encode = json.JSONEncoder(separators=(",", ":")).encode
+        if fmt == "csv":
+            self._csv_writer().writerow(fields)
+
+    def _csv_writer(self):
+        # sys.stdout is looked up on every write, the agent swaps it per request
+        return csv.writer(sys.stdout, lineterminator="\n")
+
+    def add(self, record):
+        # record: (url, name, size, mtime, permissions, is_dir)
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.records) == 0:
+            return
+        if self.format == "jsonl":
+            encode = self.encode
+            sys.stdout.write("".join(
+                jsonl_template.format(encode(url), encode(name), size, mtime, encode(permissions),
+                                      "true" if is_dir else "false")
+                for url, name, size, mtime, permissions, is_dir in self.records))
+        elif self.format == "csv":
+            self._csv_writer().writerows(i[:5]+(int(i[5]),) for i in self.records)
+        else:
+            sys.stdout.write("".join(i[0]+"\0" for i in self.records))
+        self.records = []
@@ -1,9 +1,11 @@
 from __future__ import print_function
 import argparse as ap
+import config
+import gfal_backend
+import listing_output
 import os
-import multiprocessing
 
-def get_args():
+def get_args(argv=None):
     parser = ap.ArgumentParser(
         description="General manager for durham grid storage")
     parser.add_argument(
@@ -29,7 +31,9 @@ def get_args():
     parser.add_argument(
         "--move",
         "-mv",
-        help="Move file around on grid",
+        help="""Move selected files and directories from the first directory given
+                to the second. Directories are renamed whole unless the target
+                already has one of the same name; with -rc those are merged""",
         action="store_true",
         default=False)
     parser.add_argument(
@@ -43,6 +47,18 @@ def get_args():
         "-rc",
         help="recursive search",
         action = "store_true")
+    parser.add_argument(
+        "--max_depth",
+        help="maximum depth to descend to in recursive mode",
+        type=int,
+        default=None)
+    parser.add_argument(
+        "--list_threads",
+        help="no. directories to list in parallel in recursive mode. Default={0}".format(
+            config.listing_threads),
+        action="store",
+        default=config.listing_threads,
+        type=int)
     parser.add_argument(
         "--dir",
         help="Match only directories",
@@ -56,7 +72,9 @@ def get_args():
     parser.add_argument(
         "--delete",
         "-rm",
-        help="Delete selected files",
+        help="""Delete selected files. With -rc the whole tree is searched first
+                and the deletion confirmed once. Selected directories are deleted
+                with everything in them""",
         action="store_true", default=False)
     parser.add_argument(
         "--long",
@@ -68,6 +86,13 @@ def get_args():
         "-b",
         help="bare output, when you want full filepath info",
         action="store_true", default=False)
+    parser.add_argument(
+        "--format",
+        help="""output format for listings: text, or one record per entry with URL,
+                name, size, mtime, permissions and is_dir as jsonl or csv, or null
+                for NUL separated URLs. Ignored with -cp, -mv and -rm""",
+        choices=listing_output.formats,
+        default="text")
     parser.add_argument(
         "--case_insensitive",
         "-i",
@@ -92,14 +117,32 @@ def get_args():
         "--output_directory",
         "-o",
         help="output directory for copy")
-    thread_count = multiprocessing.cpu_count()
     parser.add_argument(
         "--no_threads",
         "-j",
-        help="no. threads to run in parallel for copying from grid/deletions. Default={0}".format(thread_count),
+        help="""no. threads to run in parallel for copying from grid/deletions.
+                Default: adapt to the throughput, up to the limits set in config.py""",
         action="store",
         nargs="?",
-        default= thread_count,
+        default=None,
+        type=int)
+    parser.add_argument(
+        "--bulk",
+        help="copy files from the grid in batches, one transfer call per batch",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--batch_size",
+        help="no. files per transfer call in bulk mode. Default={0}".format(config.bulk_batch_size),
+        action="store",
+        default=config.bulk_batch_size,
+        type=int)
+    parser.add_argument(
+        "--nbstreams",
+        help="""no. parallel streams for files of at least {0} bytes, 1 for a single
+                stream. Default={1}""".format(config.large_file_size, config.large_file_streams),
+        action="store",
+        default=config.large_file_streams,
         type=int)
     parser.add_argument(
         "--timeout",
@@ -108,11 +151,48 @@ def get_args():
         nargs="?",
         default=None,
         type=int)
+    parser.add_argument(
+        "--retries",
+        help="""no. times to retry operations that fail with a transient error
+                (timeouts, connection resets, busy servers). Default={0}""".format(
+                    config.retry_attempts),
+        action="store",
+        default=config.retry_attempts,
+        type=int)
+    parser.add_argument(
+        "--failures_out",
+        help="write the list of permanently failed operations to this file as JSON",
+        default=None)
+    parser.add_argument(
+        "--agent",
+        choices=["start", "stop", "status", "run"],
+        default=None,
+        help="""start, stop or check on a background agent that answers listings
+                without the startup cost of a new process. "run" runs it in the
+                foreground""")
+    parser.add_argument(
+        "--no_agent",
+        "--no-agent",
+        help="run in this process even if an agent is running",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--metrics",
+        help="""print per-operation counts, bytes, latency percentiles, MB/s,
+                retries and concurrency at the end""",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--metrics_out",
+        "--metrics-out",
+        help="write the metrics to this file as JSON",
+        default=None)
     parser.add_argument(
         "--unique_runcards",
         "-u",
-        help="""only display unique runcards [WIP].
-                Doesn't work if numbers are in file name!""",
+        help="""group files named <runcard><seed>.<ext> by runcard, showing the
+                number and range of seeds, missing seeds and total size. With -rc
+                the groups cover every directory searched""",
         action="store_true")
     parser.add_argument(
         "--permissions",
@@ -128,6 +208,17 @@ def get_args():
         "-f",
         help="Force copy - overwrite any file already present",
         action="store_true")
+    parser.add_argument(
+        "--checksum",
+        help="""also compare adler32 checksums when deciding whether a local copy is
+                already complete""",
+        action="store_true")
+    parser.add_argument(
+        "--verify",
+        help="""compare the adler32 checksum of every copied file with the one on the
+                grid, and copy it again if they differ""",
+        action="store_true",
+        default=False)
     parser.add_argument(
         "--verbose",
         "-v",
@@ -146,28 +237,86 @@ def get_args():
     parser.add_argument(
         "--sortkey",
         "-sk",
-        help="key to sort with",
+        help="""key to sort with: name, size or mtime (time and fname are taken as
+                mtime and name). Default=name, or size with --top""",
+        choices=["name", "size", "mtime", "time", "fname"],
         type=str)
+    parser.add_argument(
+        "--top",
+        help="""only print the N matching files with the largest key (smallest with
+                --reverse) across the whole search, e.g. --top 100 -rc for the 100
+                biggest files in a tree""",
+        metavar="N",
+        default=None,
+        type=int)
     parser.add_argument(
         "--reverse",
         "-rev",
         help="Reverse sort",
         action="store_true",
         default=False)
+    parser.add_argument(
+        "--stream",
+        help="""print matching files as they are listed instead of after each
+                directory has been listed. Uses little memory for huge directories,
+                but lists recursive searches one directory at a time. Ignored with --sort""",
+        action="store_true",
+        default=False)
     parser.add_argument(
         "--summary",
         help="Only print summary of contents, not each individual file",
         action="store_true",
         default=False)
+    parser.add_argument(
+        "--du",
+        help="""print the total size and number of matching files under each
+                directory, largest first. Always searches the whole tree""",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--du_depth",
+        help="with --du, show directories down to this many levels below the one given",
+        type=int,
+        default=1)
     parser.add_argument(
         "--copy_to_grid",
         "-cpg",
         nargs="+",
         help="""copy files specified to grid directory specified
-                with -o flag""")
+                with -o flag. Directories are copied recursively""")
+    parser.add_argument(
+        "--sync",
+        choices=["down", "up"],
+        default=None,
+        help="""only copy new or changed files between the grid directory given and
+                the local directory given with -o (or the current directory).
+                down: grid to local, up: local to grid. Use -rc to sync subdirectories""")
+    parser.add_argument(
+        "--delete_extraneous",
+        "--delete-extraneous",
+        help="with --sync, also delete files that are missing on the side being synced from",
+        action="store_true",
+        default=False)
     parser.add_argument(
         "--user",
         help="user to view filesystem as. Defaults to the one set in .bashrc")
+    parser.add_argument(
+        "--backend",
+        help="how to talk to the grid: gfal2 python bindings, gfal-* commands or auto. Default={0}".format(
+            config.backend),
+        choices=gfal_backend.backend_names,
+        default=config.backend)
+    parser.add_argument(
+        "--refresh",
+        help="ignore cached directory listings and list the grid again",
+        action="store_true",
+        default=False)
+    parser.add_argument(
+        "--no_cache",
+        "--no-cache",
+        help="don't read or write the directory listing cache",
+        action="store_true",
+        default=False)
     parser.add_argument(
         "--protocol",
         "-P",
@@ -176,7 +325,7 @@ def get_args():
         default=None,
         help="Overwrite the gfal protocol")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     if args.long:
         args.verbose=True
         args.permissions = True
@@ -0,0 +1,158 @@
+from __future__ import print_function
+import asyncio
+import errno
+import os
+import queue
+import sys
+import threading
+
+class ProcessSupervisor():
+    # Runs every gfal-* child process from one asyncio loop on a background
+    # thread. Callers on any thread block on the result (run) or iterate over
+    # stdout lines as they arrive (stream), so waiting on a child costs a
+    # coroutine rather than a thread or process of its own. At most
+    # `max_processes` children are alive at once; a child still running after
+    # its timeout is killed.
+    def __init__(self, max_processes):
+        self.max_processes = max(max_processes, 1)
+        self.loop = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        with self.lock:
+            if self.loop is None:
+                ready = threading.Event()
+                thread = threading.Thread(target=self._run_loop, args=(ready,),
+                                          name="process-supervisor", daemon=True)
+                thread.start()
+                ready.wait()
+        return self.loop
+
+    def _run_loop(self, ready):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        if sys.version_info < (3, 12) and hasattr(os, "pidfd_open"):
+            # The default watcher starts a thread per child, later Pythons
+            # pick this one themselves
+            watcher = asyncio.PidfdChildWatcher()
+            watcher.attach_loop(loop)
+            asyncio.set_child_watcher(watcher)
+        self.semaphore = asyncio.Semaphore(self.max_processes)
+        self.loop = loop
+        ready.set()
+        loop.run_forever()
+
+    async def _read_lines(self, pipe, on_lines):
+        # Whole chunks rather than readline, and lines handed on a chunk at a
+        # time: a listing can be millions of lines. on_lines may return a
+        # coroutine, the pipe isn't read again until it's done
+        partial = b""
+        while True:
+            chunk = await pipe.read(65536)
+            if not chunk:
+                break
+            lines = (partial+chunk).split(b"\n")
+            partial = lines.pop()
+            if lines:
+                waiting = on_lines([i.decode("utf-8", "replace") for i in lines])
+                if waiting is not None:
+                    await waiting
+        if partial:
+            waiting = on_lines([partial.decode("utf-8", "replace")])
+            if waiting is not None:
+                await waiting
+
+    async def _supervise(self, args, timeout, on_stdout, kwargs):
+        # Returns (returncode, stderr lines), killing the child on timeout or
+        # when the caller cancels
+        async with self.semaphore:
+            try:
+                child = await asyncio.create_subprocess_exec(
+                    *args, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE, **kwargs)
+            except OSError as e:
+                return e.errno or 1, ["{0}: {1}".format(args[0], e.strerror)]
+            stderr = []
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    self._read_lines(child.stdout, on_stdout),
+                    self._read_lines(child.stderr, stderr.extend),
+                    child.wait()), timeout)
+            except asyncio.TimeoutError:
+                await self._kill(child)
+                stderr.append("{0} timed out after {1}s and was killed".format(args[0], timeout))
+                return errno.ETIMEDOUT, stderr
+            finally:
+                if child.returncode is None:
+                    await self._kill(child)
+            return child.returncode, stderr
+
+    async def _kill(self, child):
+        try:
+            child.kill()
+        except ProcessLookupError:
+            pass
+        # The child only counts as finished once its pipes are closed, and a
+        # reader held back by a full queue has stopped draining them
+        await asyncio.gather(child.stdout.read(), child.stderr.read(), child.wait())
+
+    def run(self, args, timeout=None, **kwargs):
+        stdout = []
+        future = asyncio.run_coroutine_threadsafe(
+            self._supervise(args, timeout, stdout.extend, kwargs), self._start())
+        returncode, stderr = future.result()
+        return returncode, stdout, stderr
+
+    def stream(self, args, timeout=None, **kwargs):
+        return SupervisedStream(self, args, timeout, kwargs)
+
+class SupervisedStream():
+    # Lines are handed over through a queue a chunk at a time, ending with
+    # None once the child has exited. The queue holds at most max_chunks
+    # chunks: while it is full the child's stdout isn't read, so a slow
+    # reader holds the child back instead of the listing piling up in memory
+    def __init__(self, supervisor, args, timeout, kwargs, max_chunks=16):
+        self.lines = queue.Queue(max_chunks)
+        self.closed = False
+        self.returncode = None
+        self.stderr = []
+        self.future = asyncio.run_coroutine_threadsafe(
+            self._supervise(supervisor, args, timeout, kwargs), supervisor._start())
+
+    async def _supervise(self, supervisor, args, timeout, kwargs):
+        try:
+            result = await supervisor._supervise(args, timeout, self._put, kwargs)
+        finally:
+            await self._put(None)
+        return result
+
+    async def _put(self, lines):
+        # Only the loop thread puts, so a queue that isn't full stays that way
+        if not self.lines.full():
+            self.lines.put_nowait(lines)
+            return
+        await asyncio.get_event_loop().run_in_executor(None, self._put_blocking, lines)
+
+    def _put_blocking(self, lines):
+        # Gives up once the reader has gone away
+        while not self.closed:
+            try:
+                self.lines.put(lines, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def __iter__(self):
+        try:
+            while True:
+                lines = self.lines.get()
+                if lines is None:
+                    break
+                for line in lines:
+                    yield line
+            self.returncode, self.stderr = self.future.result()
+        finally:
+            # Stopped early: no one is reading, so don't leave the child running
+            if not self.future.done():
+                self.closed = True
+                self.future.cancel()
@@ -0,0 +1,70 @@
+from __future__ import print_function
+import json
+import os
+import threading
+
+journal_name = ".dpm-manager-journal"
+
+class TransferJournal():
+    # Append-only log of the transfers into one local directory. Workers may
+    # be separate processes, so every record is a single short append. Only
+    # the latest record per file matters, so the log is rewritten without
+    # the older ones when it is loaded.
+    def __init__(self, directory):
+        self.path = os.path.join(directory, journal_name)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(self.path):
+            no_lines = 0
+            with open(self.path) as infile:
+                for line in infile:
+                    no_lines += 1
+                    try:
+                        record = json.loads(line)
+                        self.entries[record["dest"]] = record
+                    except (ValueError, KeyError):
+                        # Line cut short by an interrupted run
+                        continue
+            if no_lines > len(self.entries):
+                self._compact()
+
+    def _compact(self):
+        # Written next to the journal and renamed over it, so an interrupted
+        # run leaves either the old log or the new one
+        tmp_path = "{0}.{1}.tmp".format(self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as outfile:
+                outfile.write("".join(json.dumps(i, sort_keys=True)+"\n"
+                                      for i in self.entries.values()))
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError):
+            # Keep using the long log
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _append(self, record):
+        line = json.dumps(record, sort_keys=True)+"\n"
+        with self.lock:
+            with open(self.path, "a") as outfile:
+                outfile.write(line)
+            self.entries[record["dest"]] = record
+
+    def started(self, dest, source, size):
+        self._append({"event": "start", "dest": dest, "source": source, "size": size})
+
+    def completed(self, dest, source, size, mtime, checksum=None):
+        self._append({"event": "done", "dest": dest, "source": source, "size": size,
+                      "mtime": mtime, "checksum": checksum})
+
+    def is_partial(self, dest):
+        record = self.entries.get(dest)
+        return record is not None and record["event"] == "start"
+
+    def known_checksum(self, dest, source, size, mtime):
+        # Checksum from an earlier run, if the local file hasn't changed since
+        record = self.entries.get(dest)
+        if record is None or record["event"] != "done":
+            return None
+        if record["source"] != source or record["size"] != size or record.get("mtime") != mtime:
+            return None
+        return record.get("checksum")
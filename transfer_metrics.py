@@ -0,0 +1,124 @@
+from __future__ import print_function
+import array
+import json
+import math
+import threading
+import time
+
+def protocol_of(url):
+    if "://" in url:
+        return url.split("://", 1)[0]
+    return "file"
+
+def percentile(sorted_values, fraction):
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(int(math.ceil(fraction*len(sorted_values)))-1, len(sorted_values)-1)
+    return sorted_values[max(index, 0)]
+
+def _histogram(latencies):
+    # Power-of-two buckets starting at 1ms, keyed by the bucket's upper edge
+    buckets = {}
+    for latency in latencies:
+        edge = 0.001
+        while latency > edge:
+            edge *= 2
+        key = "<={0:g}s".format(edge)
+        buckets[key] = buckets.get(key, 0)+1
+    return buckets
+
+class OperationStats():
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.latencies = array.array("d")
+        self.rates = array.array("d")
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        rates = sorted(self.rates)
+        summary = {"count": self.count, "errors": self.errors, "retries": self.retries,
+                   "bytes": self.bytes,
+                   "latency_p50": percentile(latencies, 0.5),
+                   "latency_p90": percentile(latencies, 0.9),
+                   "latency_p99": percentile(latencies, 0.99),
+                   "latency_max": latencies[-1] if len(latencies) > 0 else 0.0,
+                   "latency_histogram": _histogram(latencies)}
+        if len(rates) > 0:
+            summary["mb_per_s_p10"] = percentile(rates, 0.1)
+            summary["mb_per_s_p50"] = percentile(rates, 0.5)
+            summary["mb_per_s_p90"] = percentile(rates, 0.9)
+        return summary
+
+class Metrics():
+    def __init__(self, sample_interval=0.1):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.stats = {}
+        self.sample_interval = sample_interval
+        self.last_sample = 0.0
+        self.concurrency = []
+
+    def _stats(self, operation, protocol):
+        key = (operation, protocol)
+        if key not in self.stats:
+            self.stats[key] = OperationStats()
+        return self.stats[key]
+
+    def record(self, operation, url, latency, nbytes=0, ok=True):
+        with self.lock:
+            stats = self._stats(operation, protocol_of(url))
+            stats.count += 1
+            stats.latencies.append(latency)
+            if not ok:
+                stats.errors += 1
+            elif nbytes > 0:
+                stats.bytes += nbytes
+                if latency > 0:
+                    stats.rates.append(nbytes/latency/1e6)
+
+    def record_retry(self, operation, url):
+        with self.lock:
+            self._stats(operation, protocol_of(url)).retries += 1
+
+    def sample_concurrency(self, running, limit):
+        now = time.time()
+        with self.lock:
+            if now-self.last_sample < self.sample_interval:
+                return
+            self.last_sample = now
+            self.concurrency.append((round(now-self.start_time, 3), running, limit))
+
+    def summary(self):
+        with self.lock:
+            operations = dict(("{0}:{1}".format(*key), stats.summary())
+                              for key, stats in sorted(self.stats.items()))
+            concurrency = list(self.concurrency)
+        wall_time = time.time()-self.start_time
+        summary = {"wall_time": wall_time, "operations": operations,
+                   "concurrency": concurrency}
+        if len(concurrency) > 0:
+            summary["concurrency_peak"] = max(i[1] for i in concurrency)
+            summary["concurrency_mean"] = sum(i[1] for i in concurrency)/float(len(concurrency))
+        return summary
+
+    def format_summary(self):
+        summary = self.summary()
+        lines = ["> Metrics over {0:.1f}s".format(summary["wall_time"])]
+        lines.append("  {0:20} {1:>7} {2:>6} {3:>7} {4:>10} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+            "operation", "count", "errors", "retries", "MB", "p50 s", "p90 s", "p99 s", "MB/s"))
+        for key, stats in summary["operations"].items():
+            lines.append("  {0:20} {1:7} {2:6} {3:7} {4:10.1f} {5:8.3f} {6:8.3f} {7:8.3f} {8:>8}".format(
+                key, stats["count"], stats["errors"], stats["retries"], stats["bytes"]/1e6,
+                stats["latency_p50"], stats["latency_p90"], stats["latency_p99"],
+                "{0:.2f}".format(stats["mb_per_s_p50"]) if "mb_per_s_p50" in stats else "-"))
+        if "concurrency_peak" in summary:
+            lines.append("  concurrency: peak {0}, mean {1:.1f}".format(
+                summary["concurrency_peak"], summary["concurrency_mean"]))
+        return "\n".join(lines)
+
+    def write_json(self, path):
+        with open(path, "w") as outfile:
+            json.dump(self.summary(), outfile, indent=2)